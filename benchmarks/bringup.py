@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Environment bring-up and teardown cost: runs testenv over generated configs
+of stand-in servers (fakeserver.py) with different sizes and `after` graphs
+and reads per phase timings from the trace. Overhead is the phase time
+beyond the critical path of stand-ins' own delays (stand-ins' interpreter
+startup is part of it).
+
+    python2.7 benchmarks/bringup.py --sizes 1 10 100 --graphs chain star --output new.json
+    python2.7 benchmarks/bringup.py --baseline old.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+GRAPHS = ('independent', 'chain', 'star', 'layered')
+RUNNER_PHASES = ('read_config', 'create_basedir', 'parametrize_config', 'start_servers', 'command',
+                 'stop_servers', 'cleanup')
+SERVER_PHASES = ('prepare', 'start', 'wait_ready', 'fill', 'stop')
+
+
+def graph_deps(graph, size):
+    # { index: [ indexes it starts after ] }
+    if graph == 'independent':
+        return dict((i, []) for i in range(size))
+    if graph == 'chain':
+        return dict((i, i and [ i - 1 ] or []) for i in range(size))
+    if graph == 'star':
+        return dict((i, i and [ 0 ] or []) for i in range(size))
+    if graph == 'layered':
+        width = max(1, int(size ** 0.5))
+        return dict((i, [ j for j in range(size) if j // width == i // width - 1 ]) for i in range(size))
+    raise Exception("unknown graph " + graph)
+
+
+def critical_path(deps, cost):
+    # longest chain of costs through the dependency graph
+    done = {}
+
+    def finish(i):
+        if i not in done:
+            done[i] = max([ finish(d) for d in deps[i] ] or [ 0 ]) + cost
+        return done[i]
+    return max([ finish(i) for i in deps ] or [ 0 ])
+
+
+def server_name(i):
+    return 's{0:03d}'.format(i)
+
+
+def make_config(opts, graph, size, basedir):
+    deps = graph_deps(graph, size)
+    servers = {}
+    for i in range(size):
+        name = server_name(i)
+        command = [ opts.python, os.path.join(HERE, 'fakeserver.py'), '--listen', '$' + name + '_addr$',
+                    '--init-delay', str(opts.init_delay), '--stop-delay', str(opts.stop_delay) ]
+        server = {
+            'type': 'testenv.server.GenericServer',
+            'command': command,
+            'address': [ '$' + name + '_ip$', '$' + name + '_port$' ],
+            'after': [ server_name(d) for d in deps[i] ],
+            'start_timeout': 60,  # measured, not enforced here
+        }
+        if opts.daemons:
+            server['pidfile'] = '$basedir$/' + name + '/fake.pid'
+            command.extend([ '--pidfile', server['pidfile'] ])
+        servers[name] = server
+    return deps, {
+        'basedir': basedir,
+        'basedir_cleanup': False,
+        'concurrency': opts.concurrency,
+        'trace': 'trace.json',
+        'log': 'testenv.log',
+        'servers': servers,
+    }
+
+
+def run_once(opts, graph, size):
+    workdir = tempfile.mkdtemp(prefix='testenv-bench-')
+    basedir = os.path.join(workdir, 'env')
+    deps, config = make_config(opts, graph, size, basedir)
+    confpath = os.path.join(workdir, 'env.yml')
+    with open(confpath, 'w') as fh:
+        json.dump(config, fh)  # json is valid yaml
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in [ ROOT, env.get('PYTHONPATH') ] if p)
+    cmd = [ opts.python, os.path.join(ROOT, 'scripts', 'testenv'), '--config', confpath,
+            '--no-template-cache', 'true' ]
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.time()
+    with open(os.devnull, 'w') as devnull:
+        code = subprocess.call(cmd, env=env, stdout=devnull, stderr=devnull)
+    wall = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if code != 0:
+        # workdir is left for investigation
+        raise Exception("testenv exited with {0}, see {1}".format(code, os.path.join(basedir, 'testenv.log')))
+    with open(os.path.join(basedir, 'trace.json')) as fh:
+        events = json.load(fh)['traceEvents']
+    if not opts.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    phases = dict((p, 0.0) for p in RUNNER_PHASES)
+    server_phases = dict((p, 0.0) for p in SERVER_PHASES)
+    for e in events:
+        if e['cat'] == 'runner' and e['name'] in phases:
+            phases[e['name']] += e['dur'] / 1e6
+        elif e['cat'] == 'server':
+            kind = e['name'].rsplit('.', 1)[-1]
+            if kind in server_phases:
+                server_phases[kind] += e['dur'] / 1e6
+    reversed_deps = dict((i, [ j for j in deps if i in deps[j] ]) for i in deps)
+    expected = {
+        'start_servers': critical_path(deps, opts.init_delay),
+        'stop_servers': critical_path(reversed_deps, opts.stop_delay),
+    }
+    return {
+        'wall': wall,
+        'cpu': (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        'phases': phases,
+        'server_phases': server_phases,  # summed over servers
+        'expected': expected,
+        'overhead': dict((p, phases[p] - expected[p]) for p in expected),
+    }
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def aggregate(runs):
+    # median of every number over repeats
+    first = runs[0]
+    if isinstance(first, dict):
+        return dict((k, aggregate([ r[k] for r in runs ])) for k in first)
+    return median(runs)
+
+
+def compare(results, baseline, threshold, min_delta):
+    # wall, cpu and overheads of scenarios present in both, True if nothing regressed
+    base = dict((r['scenario'], r) for r in baseline['results'])
+    ok = True
+    print("\n{0:24} {1:>18} {2:>10} {3:>10} {4:>8}".format('scenario', 'metric', 'baseline', 'current', 'delta'))
+    for r in results:
+        b = base.get(r['scenario'])
+        if b is None:
+            continue
+        metrics = [ ('wall', r['wall'], b['wall']), ('cpu', r['cpu'], b['cpu']) ]
+        metrics += [ (p + ' ovh', r['overhead'][p], b['overhead'][p]) for p in sorted(r['overhead']) ]
+        for metric, cur, old in metrics:
+            delta = old > 0 and (cur - old) / old or 0.0
+            mark = ''
+            if delta > threshold and cur - old > min_delta:  # tiny numbers are mostly noise
+                mark = ' !'
+                ok = False
+            print("{0:24} {1:>18} {2:10.3f} {3:10.3f} {4:+7.0%}{5}".format(
+                r['scenario'], metric, old, cur, delta, mark))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='testenv bring-up/teardown benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[ 1, 10, 50, 120 ])
+    parser.add_argument('--graphs', nargs='+', choices=GRAPHS, default=list(GRAPHS))
+    parser.add_argument('--init-delay', type=float, default=0.02, help='stand-in startup, seconds')
+    parser.add_argument('--stop-delay', type=float, default=0.01, help='stand-in shutdown, seconds')
+    parser.add_argument('--daemons', action='store_true', help='stand-ins daemonize and write pidfiles')
+    parser.add_argument('--concurrency', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--python', default=sys.executable, help='interpreter for testenv and stand-ins')
+    parser.add_argument('--output', default=None, help='write results as json')
+    parser.add_argument('--baseline', default=None, help='json of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as regression')
+    parser.add_argument('--min-delta', type=float, default=0.05, help='ignore slowdowns below this, seconds')
+    parser.add_argument('--keep', action='store_true', help='keep basedirs and configs')
+    opts = parser.parse_args()
+
+    results = []
+    print("{0:24} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8}".format(
+        'scenario', 'wall', 'cpu', 'start', 'stop', 'overhead'))
+    for graph in opts.graphs:
+        for size in opts.sizes:
+            r = aggregate([ run_once(opts, graph, size) for _ in range(opts.repeat) ])
+            r['scenario'] = '{0}-{1}'.format(graph, size)
+            results.append(r)
+            print("{0:24} {1:8.3f} {2:8.3f} {3:8.3f} {4:8.3f} {5:8.3f}".format(
+                r['scenario'], r['wall'], r['cpu'], r['phases']['start_servers'], r['phases']['stop_servers'],
+                sum(r['overhead'].values())))
+            sys.stdout.flush()
+
+    report = {
+        'options': dict((k, v) for k, v in vars(opts).items()
+                        if k not in ('output', 'baseline', 'keep', 'threshold', 'min_delta')),
+        'results': results,
+    }
+    if opts.output is not None:
+        with open(opts.output, 'w') as fh:
+            json.dump(report, fh, indent=1, sort_keys=True)
+    if opts.baseline is not None:
+        with open(opts.baseline) as fh:
+            if not compare(results, json.load(fh), opts.threshold, opts.min_delta):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in server for benchmarks: sleeps to imitate initialization, listens on
+the given address and exits some time after SIGTERM. With --pidfile it
+daemonizes like real servers do and writes the pid when ready.
+
+    fakeserver.py --listen 127.0.0.1:8000 --init-delay 0.05 --stop-delay 0.01
+"""
+
+import argparse
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+
+def parse_params():
+    parser = argparse.ArgumentParser(description='benchmark stand-in server')
+    parser.add_argument('--listen', required=True, help='ip:port or unix socket path')
+    parser.add_argument('--pidfile', default=None, help='daemonize and write pid here when ready')
+    parser.add_argument('--init-delay', type=float, default=0.0, help='seconds before listening')
+    parser.add_argument('--stop-delay', type=float, default=0.0, help='seconds from SIGTERM to exit')
+    return parser.parse_args()
+
+
+def listen(addr):
+    if addr.startswith('/'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(addr)
+    else:
+        ip, port = addr.rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((ip, int(port)))
+    sock.listen(128)
+    return sock
+
+
+def main():
+    args = parse_params()
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(time.time()))
+    if args.pidfile is not None and os.fork() != 0:
+        os._exit(0)
+    time.sleep(args.init_delay)
+    sock = listen(args.listen)
+    if args.pidfile is not None:
+        with open(args.pidfile + '.tmp', 'w') as fh:
+            fh.write(str(os.getpid()) + '\n')
+        os.rename(args.pidfile + '.tmp', args.pidfile)
+    while not stopping:
+        try:
+            r, _, _ = select.select([ sock ], [], [], 0.5)
+        except (select.error, OSError):
+            continue  # EINTR by SIGTERM
+        if r:
+            conn, _ = sock.accept()
+            conn.close()
+    time.sleep(args.stop_delay)
+    sock.close()
+    if args.listen.startswith('/'):
+        os.unlink(args.listen)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Requests/sec of HttpMock backends: every backend serves a tiny WSGI app,
+client processes hammer it over keep-alive connections for a while.
+
+    python benchmarks/httpmock.py --clients 8 --duration 5 threaded prefork
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from testenv import mock, utils  # noqa
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+
+def application(environ, start_response):
+    body = b'{"ok": true}'
+    start_response('200 OK', [ ('Content-Type', 'application/json'), ('Content-Length', str(len(body))) ])
+    return [ body ]
+
+
+def client(args):
+    port, duration = args
+    conn = HTTPConnection('127.0.0.1', port)
+    done = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            done += 1
+        except Exception:
+            conn.close()
+            conn = HTTPConnection('127.0.0.1', port)  # non keep-alive backend closed it
+    return done
+
+
+def bench(backend, opts):
+    sock = utils.listen_socket(('127.0.0.1', 0), 1024)
+    port = sock.getsockname()[1]
+    pid = os.fork()
+    if not pid:
+        signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+        sys.stderr = open(os.devnull, 'w')  # access log
+        try:
+            mock.BACKENDS[backend](application, sock, opts.workers, opts.threads)
+        finally:
+            os._exit(0)
+    sock.close()
+    try:
+        pool = multiprocessing.Pool(opts.clients)
+        total = sum(pool.map(client, [ (port, opts.duration) ] * opts.clients))
+        pool.close()
+        return total / float(opts.duration)
+    finally:
+        utils.stop_with_signal(pid, is_child=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HttpMock backends benchmark')
+    parser.add_argument('--clients', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--duration', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('backends', nargs='*', default=[ 'simple', 'threaded', 'prefork', 'gevent' ])
+    opts = parser.parse_args()
+    for backend in opts.backends:
+        if backend == 'gevent' and mock.gevent_pywsgi is None:
+            print("{0:10} skipped, gevent is not installed".format(backend))
+            continue
+        print("{0:10} {1:10.0f} req/s".format(backend, bench(backend, opts)))
+
+
+if __name__ == '__main__':
+    main()
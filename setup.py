@@ -6,6 +6,9 @@ setup(
     version = "0.10",
     packages = ['testenv', 'testenv.contrib'],
     scripts = ['scripts/testenv'],
+    entry_points = {
+        'pytest11': [ 'testenv = testenv.pytest_plugin' ],
+    },
     author = "Dmitry Smal",
     author_email = "mialinx@gmail.com",
     description = "Tool to setup test environment for unit tests",
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from . import utils
+
+
+def make_key(*parts):
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with contextlib.closing(open(path, 'rb')) as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Cache(object):
+    """
+    Cache of directory trees shared between runs. Entries are immutable and
+    live in <root>/<namespace>/<key>/data, least recently used entries are
+    evicted when the total size gets over max_size bytes (0 - no limit).
+    """
+
+    def __init__(self, root, max_size=0):
+        self.root = root
+        self.max_size = max_size
+
+    def entry(self, ns, key):
+        return os.path.join(self.root, ns, key)
+
+    @contextlib.contextmanager
+    def use(self, ns, key):
+        # yields data dir of the entry or None, entry is not evicted meanwhile
+        entry = self.entry(ns, key)
+        data = os.path.join(entry, 'data')
+        fd = None
+        try:
+            fd = os.open(os.path.join(entry, 'lock'), os.O_RDONLY)
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        except OSError:
+            pass
+        try:
+            if fd is not None and os.path.isdir(data):
+                os.utime(os.path.join(entry, 'meta.json'), None)
+                yield data
+            else:
+                yield None
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def meta(self, ns, key):
+        try:
+            with contextlib.closing(open(os.path.join(self.entry(ns, key), 'meta.json'))) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, ns, key, src, meta=None):
+        entry = self.entry(ns, key)
+        if os.path.isdir(entry):
+            return
+        if not os.path.isdir(os.path.join(self.root, ns)):
+            try:
+                os.makedirs(os.path.join(self.root, ns))
+            except OSError:
+                pass  # created concurrently
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+        try:
+            data = os.path.join(tmp, 'data')
+            utils.copy_tree(src, data)
+            meta = dict(meta or {}, size=utils.tree_size(data), created=time.time())
+            with contextlib.closing(open(os.path.join(tmp, 'meta.json'), 'w')) as fh:
+                json.dump(meta, fh)
+            open(os.path.join(tmp, 'lock'), 'w').close()
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                pass  # stored by a concurrent run
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+        self.evict()
+
+    def entries(self, ns=None):
+        # [ (last use time, size, namespace, key) ] of all entries
+        res = []
+        namespaces = ns is None and os.listdir(self.root) or [ ns ]
+        for ns in namespaces:
+            if ns.startswith('.') or not os.path.isdir(os.path.join(self.root, ns)):
+                continue
+            for key in os.listdir(os.path.join(self.root, ns)):
+                meta = self.meta(ns, key)
+                if meta is None:
+                    continue
+                mtime = os.path.getmtime(os.path.join(self.entry(ns, key), 'meta.json'))
+                res.append((mtime, meta.get('size', 0), ns, key))
+        return sorted(res)
+
+    def remove(self, ns, key):
+        entry = self.entry(ns, key)
+        try:
+            fd = os.open(os.path.join(entry, 'lock'), os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            trash = tempfile.mkdtemp(prefix='.del-', dir=self.root)
+            os.rename(entry, os.path.join(trash, key))
+        except (IOError, OSError):
+            return False  # in use or removed concurrently
+        finally:
+            os.close(fd)
+        shutil.rmtree(trash)
+        return True
+
+    def evict(self):
+        if not self.max_size or not os.path.isdir(self.root):
+            return
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, ns, key in entries:
+            if total <= self.max_size:
+                break
+            if self.remove(ns, key):
+                total -= size
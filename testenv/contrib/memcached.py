@@ -1,16 +1,207 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import json
+import os.path
+import socket
+import struct
+import sys
+import threading
+
+try:
+    from urllib.parse import unquote_to_bytes as unquote
+except ImportError:
+    from urllib import unquote
+
 from .. import server, utils
 
 
+# binary protocol
+REQUEST = 0x80
+RESPONSE = 0x81
+SETQ = 0x11
+GETKQ = 0x0d
+NOOP = 0x0a
+HEADER = struct.Struct('!BBHBBHIIQ')
+
+
+def packet(opcode, key=b'', value=b'', extras=b'', opaque=0):
+    header = HEADER.pack(REQUEST, opcode, len(key), len(extras), 0, 0,
+                         len(extras) + len(key) + len(value), opaque, 0)
+    return header + extras + key + value
+
+
+def setq(key, value, flags=0, exptime=0):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    if not isinstance(value, bytes):
+        if not isinstance(value, type(u'')):
+            value = json.dumps(value)
+        value = value.encode('utf-8')
+    return packet(SETQ, key, value, struct.pack('!II', flags, exptime))
+
+
 class Memcached(server.Server):
 
     binary = 'memcached'
+    probe = 'memcached'
+    memory = 64         # MB
+    threads = 4
+    connections = 1024
 
     def init(self, **kwargs):
         self.binary = utils.find_binary(kwargs.get('memcached_bin', self.binary))
         assert 'ip' in kwargs, "memcached servers requires <ip> option"
         self.ip = kwargs['ip']
         assert 'port' in kwargs, "memcached server require <port> option"
-        self.port = kwargs['port']
-        self.command = [ self.binary, '-l', self.ip, '-p', self.port ]
+        self.port = int(kwargs['port'])
+        self.address = (self.ip, self.port)
+        self.memory = kwargs.get('memory', self.memory)
+        self.threads = kwargs.get('threads', self.threads)
+        self.connections = kwargs.get('connections', self.connections)
+        self.data = kwargs.get('data', [])
+        if not isinstance(self.data, list):
+            self.data = [ self.data ]
+        self.data = [ self.confpath(d) for d in self.data ]
+        self.command = [ self.binary, '-l', self.ip, '-p', str(self.port), '-U', '0',
+                         '-m', str(self.memory), '-t', str(self.threads), '-c', str(self.connections) ]
+        self.command += [ str(o) for o in kwargs.get('options', []) ]
+
+    def connect(self):
+        return socket.create_connection(self.address)
+
+    def text_command(self, line):
+        with contextlib.closing(self.connect()) as s:
+            s.sendall(line.encode('ascii') + b'\r\n')
+            with contextlib.closing(s.makefile('rb')) as fh:
+                return fh.readline().rstrip(b'\r\n')
+
+    def packets(self, path):
+        # binary protocol dump as is from .bin files, json lines otherwise:
+        # { "key": ..., "value": ..., "flags": 0, "exptime": 0 }
+        with contextlib.closing(open(path, 'rb')) as fh:
+            if path.endswith('.bin'):
+                for chunk in iter(lambda: fh.read(1 << 16), b''):
+                    yield chunk
+                return
+            batch = []
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                item = json.loads(line.decode('utf-8'))
+                batch.append(setq(item['key'], item['value'], item.get('flags', 0), item.get('exptime', 0)))
+                if len(batch) >= 1000:
+                    yield b''.join(batch)
+                    batch = []
+            yield b''.join(batch)
+
+    def pipe(self, path):
+        # quiet sets answer on errors only, NOOP at the end marks completion;
+        # responses are read concurrently so errors can't block the sender
+        s = self.connect()
+        errors = []
+
+        def send():
+            try:
+                for chunk in self.packets(path):
+                    s.sendall(chunk)
+                s.sendall(packet(NOOP))
+            except Exception as e:
+                errors.append(str(e))
+                s.shutdown(socket.SHUT_RDWR)
+        sender = threading.Thread(target=send)
+        sender.daemon = True
+        sender.start()
+        with contextlib.closing(s.makefile('rb')) as fh:
+            try:
+                while True:
+                    header = fh.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        raise Exception("memcached closed connection")
+                    magic, opcode, keylen, extlen, _, status, bodylen, _, _ = HEADER.unpack(header)
+                    body = fh.read(bodylen)
+                    if opcode == NOOP:
+                        break
+                    if status != 0:
+                        message = body[extlen + keylen:].decode('utf-8', 'replace')
+                        errors.append("status {0}: {1}".format(status, message))
+            finally:
+                sender.join()
+                s.close()
+        if errors:
+            raise Exception("{0}: {1} errors loading {2}, first: {3}".format(self.name, len(errors), path, errors[0]))
+
+    def flush_all(self):
+        # invalidates every item at once, much cheaper than a restart
+        reply = self.text_command('flush_all')
+        if reply != b'OK':
+            raise Exception("{0}: flush_all failed: {1}".format(self.name, reply.decode('utf-8', 'replace')))
+
+    def reset(self):
+        self.flush_all()
+        self.fill()
+
+    def keys(self):
+        # (key, expiration unix time or 0) of live items, lru_crawler metadump is 1.4.31+
+        items = []
+        with contextlib.closing(self.connect()) as s:
+            s.sendall(b'lru_crawler metadump all\r\n')
+            with contextlib.closing(s.makefile('rb')) as fh:
+                for line in iter(fh.readline, b''):
+                    line = line.rstrip(b'\r\n')
+                    if line == b'END':
+                        return items
+                    if not line.startswith(b'key='):
+                        raise Exception("{0}: can't list keys for checkpoint: {1}".format(
+                            self.name, line.decode('utf-8', 'replace')))
+                    fields = dict(f.split(b'=', 1) for f in line.split(b' ') if b'=' in f)
+                    items.append((unquote(fields[b'key']), max(int(fields[b'exp']), 0)))
+        raise Exception("memcached closed connection")
+
+    def dump(self):
+        # every live item as binary protocol sets, loadable by pipe(); quiet gets
+        # answer on hits only, items gone since keys() are left out; small batches
+        # keep requests within socket buffers while replies are not read
+        expires = dict(self.keys())
+        keys = list(expires)
+        chunks = []
+        with contextlib.closing(self.connect()) as s:
+            with contextlib.closing(s.makefile('rb')) as fh:
+                for i in range(0, len(keys), 100):
+                    s.sendall(b''.join(packet(GETKQ, key) for key in keys[i:i + 100]) + packet(NOOP))
+                    while True:
+                        header = fh.read(HEADER.size)
+                        if len(header) < HEADER.size:
+                            raise Exception("memcached closed connection")
+                        magic, opcode, keylen, extlen, _, status, bodylen, _, _ = HEADER.unpack(header)
+                        body = fh.read(bodylen)
+                        if opcode == NOOP:
+                            break
+                        if status == 0:
+                            flags, = struct.unpack('!I', body[:4])
+                            key = body[extlen:extlen + keylen]
+                            chunks.append(setq(key, body[extlen + keylen:], flags, expires[key]))
+        return b''.join(chunks)
+
+    def flush(self):
+        self.dumped = self.dump()  # the server is stopped during checkpoint()
+
+    def checkpoint(self, path):
+        os.makedirs(path)
+        with contextlib.closing(open(os.path.join(path, 'dump.bin'), 'wb')) as fh:
+            fh.write(self.dumped)
+        self.dumped = None
+
+    def rollback(self, path):
+        # items set after checkpoint go away with flush_all
+        self.flush_all()
+        self.pipe(os.path.join(path, 'dump.bin'))
+        return False
+
+    def fill(self):
+        for path in self.data:
+            started = utils.monotonic()
+            self.pipe(path)
+            sys.stderr.write("{0}: {1} loaded in {2:.2f}s\n".format(
+                self.name, os.path.basename(path), utils.monotonic() - started))
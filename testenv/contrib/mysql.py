@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import csv
+import json
 import os
 import os.path
 import re
 import subprocess
+import sys
 from distutils.version import LooseVersion
 
-from .. import server, utils
+from .. import cache, server, utils
 
 
 class MySQL(server.Server):
@@ -16,6 +20,15 @@ class MySQL(server.Server):
     mysqladmin_bin        = 'mysqladmin'
     mysql_bin             = 'mysql'
 
+    stop_timeout = 60  # innodb clean shutdown may take a while
+    probe = 'mysql'
+    checkpoint_ignore = ('*.pid', 'mysql.log', 'slow.log')
+    # written by innodb in background, its log sequence number tells about data changes instead
+    innodb_files = ('ib_logfile*', 'ibdata*', 'ibtmp*', 'ib_buffer_pool', '#ib_*', 'undo_*', '*.ibd', '*.ibt')
+    admin_user = 'testenv_admin'  # passwordless, local socket only; created by init.sql
+
+    snapshot_base = None
+
     default_config = {
         'client': {},
         'mysqld': {
@@ -35,6 +48,8 @@ class MySQL(server.Server):
             'slow_query_log': '1',
             'long_query_time': '1',
             'log-queries-not-using-indexes': '1',
+
+            'local_infile': '1',
         },
         'innodb': {
             'innodb_buffer_pool_size': '8M',
@@ -46,6 +61,18 @@ class MySQL(server.Server):
         }
     }
 
+    ephemeral_config = {
+        'mysqld': {
+            'sync_binlog': '0',
+            'general_log': '0',
+            'slow_query_log': '0',
+            'log-queries-not-using-indexes': '0',
+            'innodb_doublewrite': '0',
+            'innodb_flush_method': 'nosync',
+            'innodb_flush_log_at_trx_commit': '0',
+        },
+    }
+
     def init(self, **kwargs):
         # main configuration
         assert 'config' in kwargs and type(kwargs['config']) == dict, \
@@ -54,6 +81,7 @@ class MySQL(server.Server):
         self.datadir = os.path.join(self.basedir, 'data')
         self.config = utils.merge(
             self.default_config,
+            self.presets(),
             kwargs['config'],
             {
                 'mysqld': {
@@ -89,19 +117,36 @@ class MySQL(server.Server):
         self.vendor = 'MariaDB' in version and 'MariaDB' or 'MySQL'
         self.version = match.group(0)
 
+        # binlog is on by default since 8.0
+        if self.presets() and self.vendor == 'MySQL' and LooseVersion(self.version) >= LooseVersion('8.0'):
+            if 'log-bin' not in kwargs['config'].get('mysqld', {}):
+                self.config['mysqld'].setdefault('disable-log-bin', None)
+
         # users and schemas
         self.databases = kwargs.get('databases', [])
         assert type(self.databases) == list, "<database> section should be a list"
         self.users = kwargs.get('users', [])
         assert type(self.users) == list, "<users> section should be a list"
+        after = dict((db['name'], self.database_after(db)) for db in self.databases)
+        for name, deps in after.items():
+            for d in deps:
+                assert d in after, "database {0} should be after unknown database {1}".format(name, d)
+        utils.order_graph(sorted(after), after.get, 'databases')  # cycles would leave databases empty
+        self.fill_concurrency = kwargs.get('fill_concurrency', 4)
+        self.bulk_load = kwargs.get('bulk_load', False)
         self.scheme2users = {}
+        self.filled = {}  # database name -> key of its content in datadir
 
     def prepare(self):
         super(MySQL, self).prepare()
         utils.write_ini(self.configfile, self.config)
 
         with open(os.path.join(self.basedir, 'init.sql'), "w") as fh:
-            sql = ''
+            if LooseVersion(self.version) >= LooseVersion(self.vendor == 'MySQL' and '5.7.6' or '10.1.3'):
+                sql = "CREATE USER IF NOT EXISTS '{0}'@'localhost';\n".format(self.admin_user)
+                sql += "GRANT ALL PRIVILEGES ON *.* TO '{0}'@'localhost';\n".format(self.admin_user)
+            else:
+                sql = "GRANT ALL PRIVILEGES ON *.* TO '{0}'@'localhost' IDENTIFIED BY '';\n".format(self.admin_user)
             for db in self.databases:
                 sql += "CREATE DATABASE `{name}` DEFAULT CHARACTER SET 'utf8';\n".format(**db)
             for u in self.users:
@@ -111,6 +156,73 @@ class MySQL(server.Server):
                 sql += "FLUSH PRIVILEGES;\n"
             fh.write(sql)
 
+        if self.runner.cache is None:
+            self.initialize()
+        else:
+            self.prepare_from_template()
+
+        self.command = [ self.mysqld_bin, '--defaults-file=' + self.configfile ]
+
+    def template_key(self):
+        # paths inside basedir and listen addresses differ from run to run
+        config = {}
+        for section, options in self.config.items():
+            config[section] = dict((k, v) for k, v in options.items() if k not in ('port', 'socket', 'bind-address'))
+        config = json.dumps(config, sort_keys=True).replace(self.basedir, '')
+        with contextlib.closing(open(os.path.join(self.basedir, 'init.sql'))) as fh:
+            init_sql = fh.read()
+        return cache.make_key(self.mysqld_bin, self.version, self.vendor, config, init_sql)
+
+    def database_keys(self):
+        # databases names and users are part of template key already
+        keys = {}
+        for db in self.databases:
+            files = []
+            for scheme in self.schemes(db):
+                files.append(scheme)
+                files.extend(self.data_files(scheme))
+            keys[db['name']] = cache.make_key([ cache.file_hash(f) for f in files ])
+        return keys
+
+    def find_snapshot(self, base, keys):
+        # snapshot with the most databases matching current schemes
+        best = None
+        for mtime, size, ns, key in self.runner.cache.entries('mysql-filled'):
+            meta = self.runner.cache.meta(ns, key)
+            if meta is None or meta.get('base') != base:
+                continue
+            score = sum(1 for name, k in meta['databases'].items() if keys.get(name) == k)
+            if score > 0 and (best is None or score >= best[0]):
+                best = (score, key, meta)
+        return best
+
+    def prepare_from_template(self):
+        key = self.template_key()
+        self.snapshot_base = key
+        snapshot = self.find_snapshot(key, self.database_keys())
+        if snapshot is not None:
+            with self.runner.cache.use('mysql-filled', snapshot[1]) as data:
+                if data is not None:
+                    utils.copy_tree(data, self.datadir)
+                    self.filled = snapshot[2]['databases']
+                    return
+        with self.runner.cache.use('mysql-datadir', key) as template:
+            if template is not None:
+                utils.copy_tree(template, self.datadir)
+                return
+        self.initialize()
+        self.runner.cache.put('mysql-datadir', key, self.datadir,
+                              { 'mysqld': self.mysqld_bin, 'version': self.version })
+
+    def save_snapshot(self, keys):
+        # datadir is consistent only after clean shutdown
+        self.stop()
+        self.runner.cache.put('mysql-filled', cache.make_key(self.snapshot_base, keys), self.datadir,
+                { 'base': self.snapshot_base, 'databases': keys })
+        self.start()
+        self.wait_ready()
+
+    def initialize(self):
         if self.vendor == 'MySQL' and LooseVersion(self.version) >= LooseVersion('5.7.6'):
             p = subprocess.Popen([self.mysqld_bin, '--defaults-file=' + self.configfile, '--initialize'])
             utils.wait_for_proc(p, name=self.mysqld_bin)
@@ -126,17 +238,150 @@ class MySQL(server.Server):
             )
             utils.wait_for_proc(p, name=self.mysql_install_db_bin)
 
-        self.command = [ self.mysqld_bin, '--defaults-file=' + self.configfile ]
+    def mysql(self, db, stdin=None, sql=None, database=True):
+        user, password = self.scheme2users.get(db['name']) or ['', '']
+        args = [ self.mysql_bin, '--defaults-file=' + self.configfile, '--user=' + user, '--password=' + password ]
+        if self.bulk_load:
+            args.append('--local-infile=1')
+        if database:
+            args.append(db['name'])
+        if sql is not None:
+            stdin = subprocess.PIPE
+        p = subprocess.Popen(args, stdin=stdin, universal_newlines=True)
+        p.communicate(sql)
+        utils.wait_for_proc(p, name=self.mysql_bin)
+
+    def recreate_database(self, db):
+        sql = "DROP DATABASE `{name}`;\nCREATE DATABASE `{name}` DEFAULT CHARACTER SET 'utf8';\n".format(**db)
+        self.mysql(db, sql=sql, database=False)
+
+    def schemes(self, db):
+        schemes = db.get('scheme', [])
+        if not isinstance(schemes, list):
+            schemes = [ schemes ]
+        return [ self.confpath(s) for s in schemes ]
+
+    def data_files(self, scheme):
+        # <table>.csv / <table>.tsv in dir named as scheme without extension
+        datadir = os.path.splitext(scheme)[0]
+        if not self.bulk_load or not os.path.isdir(datadir):
+            return []
+        files = [ f for f in sorted(os.listdir(datadir)) if f.endswith(('.csv', '.tsv')) ]
+        return [ os.path.join(datadir, f) for f in files ]
+
+    def load_data(self, db, path):
+        # first line of data file is a header with column names
+        table = os.path.splitext(os.path.basename(path))[0]
+        delimiter = path.endswith('.tsv') and '\t' or ','
+        with contextlib.closing(open(path, 'r')) as fh:
+            header = next(csv.reader(fh, delimiter=delimiter))
+        sql = (
+            "SET SESSION foreign_key_checks = 0;\n"
+            "SET SESSION unique_checks = 0;\n"
+            "SET SESSION autocommit = 0;\n"
+            "LOAD DATA LOCAL INFILE '{path}' INTO TABLE `{table}` CHARACTER SET utf8\n"
+            "    FIELDS TERMINATED BY '{delimiter}' OPTIONALLY ENCLOSED BY '\"'\n"
+            "    LINES TERMINATED BY '\\n' IGNORE 1 LINES ({columns});\n"
+            "COMMIT;\n"
+        ).format(
+            path=path.replace('\\', '\\\\').replace("'", "\\'"),
+            table=table,
+            delimiter=delimiter == '\t' and '\\t' or delimiter,
+            columns=', '.join('`{0}`'.format(c.strip()) for c in header),
+        )
+        self.mysql(db, sql=sql)
+
+    def timed(self, db, path, code, *args):
+        started = utils.monotonic()
+        code(*args)
+        sys.stderr.write("{0}: {1} {2} loaded in {3:.2f}s\n".format(
+            self.name, db['name'], os.path.basename(path), utils.monotonic() - started))
+
+    def fill_database(self, db):
+        for scheme in self.schemes(db):
+            with contextlib.closing(open(scheme, 'r')) as fh:
+                self.timed(db, scheme, self.mysql, db, fh)
+            for path in self.data_files(scheme):
+                self.timed(db, path, self.load_data, db, path)
+
+    def database_after(self, db):
+        after = db.get('after', [])
+        return after if isinstance(after, list) else [ after ]
+
+    def load_databases(self, names):
+        databases = dict((db['name'], db) for db in self.databases)
+
+        def deps(name):
+            return [ d for d in self.database_after(databases[name]) if d in names ]
+
+        def load(name):
+            if name in self.filled:
+                self.recreate_database(databases[name])  # stale content from snapshot or previous run
+            self.fill_database(databases[name])
+
+        errors = utils.run_graph(names, deps, load, workers=self.fill_concurrency)
+        if errors:
+            utils.report_errors(names, errors, 'load', 'databases', lambda name: name)
+
+    def query(self, sql):
+        # output of sql run by the admin user, tab separated
+        args = [ self.mysql_bin, '--defaults-file=' + self.configfile, '--user=' + self.admin_user, '--password=',
+                 '--batch', '--skip-column-names', '--execute=' + sql ]
+        return subprocess.check_output(args, universal_newlines=True)
+
+    def state(self):
+        # marker of data: innodb log sequence number and files of other engines
+        lsn = re.search(r'Log sequence number\s+(\d+)', self.query('SHOW ENGINE INNODB STATUS'))
+        ignore = self.checkpoint_ignore + self.innodb_files
+        return json.dumps({ 'lsn': lsn and lsn.group(1), 'files': utils.tree_manifest(self.datadir, ignore) },
+                          sort_keys=True)
+
+    def save_state(self, path):
+        with contextlib.closing(open(os.path.join(path, 'state.json'), 'w')) as fh:
+            fh.write(self.state())
+
+    def flush(self):
+        # copy of innodb files is consistent only after clean shutdown: with
+        # innodb_flush_log_at_trx_commit 0/2 the redo log is written lazily and page
+        # writes may be in flight; slow shutdown leaves no purge for the next start
+        self.query('SET GLOBAL innodb_fast_shutdown = 0')
+        self.runner.stop_server(self)
+
+    def pause(self):
+        if self.is_running():
+            super(MySQL, self).pause()
+
+    def checkpoint(self, path):
+        # state is taken after restart, startup writes files of its own
+        super(MySQL, self).checkpoint(path)
+        self.runner.respawn_server(self)
+        self.save_state(path)
+
+    def changed(self, path):
+        state = os.path.join(path, 'state.json')
+        if not os.path.exists(state):
+            return True
+        with contextlib.closing(open(state)) as fh:
+            return fh.read() != self.state()
+
+    def rollback(self, path):
+        restarted = super(MySQL, self).rollback(path)
+        if restarted:
+            self.save_state(path)  # restart from restored files is the checkpoint state
+        return restarted
+
+    def log_files(self):
+        return [ self.config['mysqld']['log_error'] ]
 
     def fill(self):
-        for db in self.databases:
-            if 'scheme' not in db:
-                continue
-            if not isinstance(db['scheme'], list):
-                db['scheme'] = [ db['scheme'], ]
-            for scheme in db['scheme']:
-                user, password = self.scheme2users.get(db['name']) or ['', '']
-                scheme = self.confpath(scheme)
-                p = subprocess.Popen([self.mysql_bin, '--defaults-file=' + self.configfile,
-                        '--user=' + user, '--password=' + password, db['name']], stdin=open(scheme, 'r'))
-                utils.wait_for_proc(p, name=self.mysql_bin)
+        keys = self.database_keys()
+        changed = [ db['name'] for db in self.databases if self.filled.get(db['name']) != keys[db['name']] ]
+        if not changed:
+            return
+        self.load_databases(changed)
+        self.filled = keys
+        if self.runner.cache is not None:
+            self.save_snapshot(keys)
+
+    def reset(self):
+        self.load_databases([ db['name'] for db in self.databases ])
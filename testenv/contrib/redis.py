@@ -1,8 +1,194 @@
 # -*- coding: utf-8 -*-
 
-from .. import server
+import binascii
+import contextlib
+import os
+import os.path
+import shlex
+import shutil
+import socket
+import sys
+import threading
+
+from .. import server, utils
+
+
+def encode_command(args):
+    out = [ '*{0}\r\n'.format(len(args)).encode('ascii') ]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = arg.encode('utf-8')
+        out.append('${0}\r\n'.format(len(arg)).encode('ascii') + arg + b'\r\n')
+    return b''.join(out)
+
+
+def split_command(line):
+    # values stay bytes: shlex of python2 fails on non-ascii unicode, python3 one takes text only
+    if isinstance(line, str):
+        return shlex.split(line)
+    return [ arg.encode('utf-8', 'surrogateescape') for arg in shlex.split(line.decode('utf-8', 'surrogateescape')) ]
+
+
+def read_reply(fh):
+    # (type, value) of one RESP reply, arrays are lists of values
+    line = fh.readline()
+    if not line:
+        raise Exception("redis closed connection")
+    kind, data = line[:1], line[1:-2]
+    if kind == b'$':
+        if int(data) < 0:
+            return kind, None
+        value = fh.read(int(data) + 2)[:-2]
+        return kind, value
+    if kind == b'*':
+        return kind, [ read_reply(fh)[1] for i in range(max(0, int(data))) ]
+    return kind, data
 
 
 class Redis(server.Server):
-    # TODO
-    pass
+
+    redis_bin = 'redis-server'
+    probe = 'redis'
+    ip = '127.0.0.1'
+    port = None
+    unixsocket = None
+
+    default_config = {
+        'daemonize': 'no',
+        'save': '""',  # no persistence for test data
+        'appendonly': 'no',
+        'loglevel': 'notice',
+    }
+
+    def init(self, **kwargs):
+        self.redis_bin = utils.find_binary(kwargs.get('redis_bin', self.redis_bin))
+        assert self.redis_bin is not None, "can't find redis-server binary"
+        assert 'port' in kwargs or 'unixsocket' in kwargs, "redis server requires <port> or <unixsocket> option"
+        self.configfile = os.path.join(self.basedir, 'redis.conf')
+        self.config = utils.merge(
+            self.default_config,
+            self.presets(),
+            {
+                'dir': self.basedir,
+                'logfile': os.path.join(self.basedir, 'redis.log'),
+                'port': 0,
+            },
+            kwargs.get('config', {}),
+        )
+        if 'port' in kwargs:
+            self.ip = kwargs.get('ip', self.ip)
+            self.port = int(kwargs['port'])
+            self.config['bind'] = self.ip
+            self.config['port'] = self.port
+            self.address = (self.ip, self.port)
+        if kwargs.get('unixsocket'):
+            self.unixsocket = kwargs['unixsocket']
+            if self.unixsocket is True:
+                self.unixsocket = os.path.join(self.basedir, 'redis.sock')
+            self.config['unixsocket'] = self.unixsocket
+            self.address = self.unixsocket  # preferred by clients in tests
+        self.data = kwargs.get('data', [])
+        if not isinstance(self.data, list):
+            self.data = [ self.data ]
+        self.data = [ self.confpath(d) for d in self.data ]
+        self.rdb = [ d for d in self.data if d.endswith('.rdb') ]
+        assert len(self.rdb) <= 1, "redis server may preload only one .rdb file"
+        self.command = [ self.redis_bin, self.configfile ]
+
+    def prepare(self):
+        super(Redis, self).prepare()
+        with contextlib.closing(open(self.configfile, 'w')) as fh:
+            for k, v in sorted(self.config.items()):
+                fh.write('{0} {1}\n'.format(k, v))
+        if self.rdb:
+            # loaded at startup, before redis accepts queries
+            shutil.copy(self.rdb[0], os.path.join(self.basedir, self.config.get('dbfilename', 'dump.rdb')))
+
+    def connect(self):
+        family, addr = utils.parse_address(self.address)
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.connect(addr)
+        return s
+
+    def commands(self, path):
+        # redis protocol as is from .resp files, text commands one per line otherwise
+        with contextlib.closing(open(path, 'rb')) as fh:
+            if path.endswith('.resp'):
+                for chunk in iter(lambda: fh.read(1 << 16), b''):
+                    yield chunk
+                return
+            batch = []
+            for line in fh:
+                line = line.strip()
+                if line and not line.startswith(b'#'):
+                    batch.append(encode_command(split_command(line)))
+                if len(batch) >= 1000:
+                    yield b''.join(batch)
+                    batch = []
+            yield b''.join(batch)
+
+    def pipe(self, path):
+        # sends everything without waiting, replies are read concurrently
+        # until the echo of a marker appended to the stream (redis-cli --pipe)
+        marker = binascii.hexlify(os.urandom(20))
+        s = self.connect()
+        errors = []
+
+        def send():
+            try:
+                for chunk in self.commands(path):
+                    s.sendall(chunk)
+                s.sendall(encode_command([ 'ECHO', marker ]))
+            except Exception as e:
+                errors.append(str(e))
+                s.shutdown(socket.SHUT_RDWR)
+        sender = threading.Thread(target=send)
+        sender.daemon = True
+        sender.start()
+        replies = 0
+        with contextlib.closing(s.makefile('rb')) as fh:
+            try:
+                while True:
+                    kind, value = read_reply(fh)
+                    if value == marker:
+                        break
+                    replies += 1
+                    if kind == b'-':
+                        errors.append(value.decode('utf-8', 'replace'))
+            finally:
+                sender.join()
+                s.close()
+        if errors:
+            raise Exception("{0}: {1} errors loading {2}, first: {3}".format(self.name, len(errors), path, errors[0]))
+        return replies
+
+    def query(self, *args):
+        with contextlib.closing(self.connect()) as s:
+            s.sendall(encode_command(args))
+            with contextlib.closing(s.makefile('rb')) as fh:
+                kind, value = read_reply(fh)
+        if kind == b'-':
+            raise Exception("{0}: {1} failed: {2}".format(self.name, args[0], value.decode('utf-8', 'replace')))
+        return value
+
+    def flush(self):
+        self.query('SAVE')  # dataset lives in memory, checkpoint copies the rdb
+
+    def changed(self, path):
+        for line in self.query('INFO', 'persistence').splitlines():
+            if line.startswith(b'rdb_changes_since_last_save:') and int(line.split(b':')[1]) > 0:
+                return True
+        return super(Redis, self).changed(path)
+
+    def log_files(self):
+        # empty logfile is stdout
+        return [ f for f in [ self.config['logfile'] ] if f ] + super(Redis, self).log_files()
+
+    def fill(self):
+        for path in self.data:
+            if path in self.rdb:
+                continue
+            started = utils.monotonic()
+            replies = self.pipe(path)
+            sys.stderr.write("{0}: {1} commands from {2} in {3:.2f}s\n".format(
+                self.name, replies, os.path.basename(path), utils.monotonic() - started))
@@ -1,16 +1,35 @@
 # -*- coding: utf-8 -*-
 
 import contextlib
+import json
 import os
 import os.path
+import re
+import shutil
+import tempfile
 
-from .. import server, utils
+from .. import cache, server, utils
+
+
+REQUIRE = re.compile(r'''\brequire\s*\(?\s*['"]([\w.-]+)['"]''')
 
 
 class Tarantool(server.Server):
+    """
+    With snapshot_cache: true (and template cache enabled), the first start
+    saves a snapshot taken right after lua_script, later runs recover from
+    it. lua_script is run anyway (functions aren't saved in snapshots) and
+    has to check global testenv_recovered to skip creating spaces, users
+    and data, that's why the cache is opt-in.
+    """
 
     tarantool_bin = 'tarantool'
     start_timeout = 50
+    probe = 'tarantool'
+    stop_timeout = 15
+    snapshot_cache = False
+    recovered = False
+    snapshot = None  # cache key
 
     default_config = {
         'background': True,
@@ -20,6 +39,11 @@ class Tarantool(server.Server):
         'snapshot_count': 2,
     }
 
+    ephemeral_config = {
+        'wal_mode': 'none',
+        'snapshot_period': 0,
+    }
+
     def init(self, **kwargs):
         super(Tarantool, self).init(**kwargs)
         self.tarantool_bin = kwargs.get('tarantool_bin', self.tarantool_bin)
@@ -27,6 +51,7 @@ class Tarantool(server.Server):
         self.pidfile = os.path.join(self.basedir, 'tarantool.pid')
         self.config = utils.merge(
             self.default_config,
+            self.presets(),
             {
                 'pid_file': self.pidfile,
                 'logger': os.path.join(self.basedir, 'tarantool.log'),
@@ -47,8 +72,46 @@ class Tarantool(server.Server):
         self.address = self.listen.split(':')
         self.command = [ self.tarantool_bin, self.configfile ]
 
+    def snap_dir(self):
+        return os.path.join(self.basedir, self.config.get('memtx_dir') or self.config.get('snap_dir') or '.')
+
+    def use_cache(self):
+        return bool(self.snapshot_cache) and self.runner.cache is not None
+
+    def lua_modules(self):
+        # lua_script and the modules it requires, found by lua_path as tarantool would;
+        # modules outside lua_path (rocks, builtins) are not part of the key
+        files = []
+        pending = [ self.lua_script ]
+        while pending:
+            path = pending.pop(0)
+            if path in files:
+                continue
+            files.append(path)
+            with contextlib.closing(open(path)) as fh:
+                names = REQUIRE.findall(fh.read())
+            for name in names:
+                for pattern in self.lua_path.split(';'):
+                    candidate = pattern.replace('?', name.replace('.', os.sep))
+                    if '?' in pattern and os.path.isfile(candidate):
+                        pending.append(os.path.abspath(candidate))
+                        break
+        return files
+
+    def snapshot_key(self):
+        files = self.lua_modules()
+        config = dict((k, v) for k, v in self.config.items() if k not in ('pid_file', 'logger', 'work_dir'))
+        return cache.make_key(self.tarantool_bin, [ cache.file_hash(f) for f in files ],
+                              json.dumps(config, sort_keys=True).replace(self.basedir, ''))
+
     def prepare(self):
         super(Tarantool, self).prepare()
+        if self.use_cache():
+            self.snapshot = self.snapshot_key()
+            with self.runner.cache.use('tarantool-snap', self.snapshot) as snap:
+                if snap is not None:
+                    utils.copy_tree(snap, self.snap_dir())
+                    self.recovered = True
         cfg = ''
         cfg += "package.path = '{0};' .. package.path\n".format(self.lua_path)
         cfg += "box.cfg({\n"
@@ -62,11 +125,34 @@ class Tarantool(server.Server):
                 cfg += '"' + str(v).replace('"', '\\"') + '"'
             cfg += ',\n'
         cfg += "})\n"
+        cfg += "testenv_recovered = {0}\n".format(str(self.recovered).lower())
         cfg += "dofile('{0}')\n".format(self.lua_script)
+        if self.use_cache() and not self.recovered:
+            cfg += "box.snapshot()\n"
         cfg += 'box.cfg({ listen = "' + str(self.listen) + '" })\n'
         with contextlib.closing(open(self.configfile, "w")) as fh:
             fh.write(cfg)
 
-    def is_ready(self):
-        res = utils.wait_for_socket(self.address, maxtime=0)
-        return res
+    def changed(self, path):
+        # without wal changes never reach files, restart is the only way to be sure
+        if self.config.get('wal_mode') == 'none':
+            return True
+        return super(Tarantool, self).changed(path)
+
+    def log_files(self):
+        logger = self.config.get('logger')
+        return [ logger ] if isinstance(logger, basestring) and os.path.isabs(logger) else []
+
+    def fill(self):
+        if not self.use_cache() or self.recovered:
+            return
+        # latest snapshot has everything, xlogs are not needed
+        snaps = sorted(f for f in os.listdir(self.snap_dir()) if f.endswith('.snap'))
+        if not snaps:
+            return
+        tmp = tempfile.mkdtemp(dir=self.basedir)
+        try:
+            shutil.copy(os.path.join(self.snap_dir(), snaps[-1]), tmp)
+            self.runner.cache.put('tarantool-snap', self.snapshot, tmp)
+        finally:
+            shutil.rmtree(tmp)
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import errno
+import json
 import os
 import os.path
+import socket
 
 from .. import server, utils
 
@@ -9,33 +12,127 @@ from .. import server, utils
 class Uwsgi(server.Server):
 
     binary = 'uwsgi'
+    start_timeout = 30
+    stop_timeout = 30
 
     default_config = {
-        'threats': 2,
+        'master': 'true',
+        'workers': 2,
+        'threads': 2,
+        'listen': 128,
+        'vacuum': 'true',
     }
 
     def init(self, **kwargs):
         assert 'config' in kwargs and type(kwargs['config']) == dict, \
             "uwsgi server requires <config> section"
-        assert os.path.exists(kwargs['config']['wsgi-file']), \
-            "uwsgi server requires wsgi-file"
+        assert 'wsgi-file' in kwargs['config'], "uwsgi server requires wsgi-file"
+        wsgi_file = self.confpath(kwargs['config']['wsgi-file'])
+        assert os.path.exists(wsgi_file), "uwsgi server requires wsgi-file"
+        self.binary = utils.find_binary(kwargs.get('uwsgi_bin', self.binary))
+        assert self.binary is not None, "can't find uwsgi binary"
         self.configfile = os.path.join(self.basedir, 'uwsgi.ini')
-        self.pidfile = os.path.join(self.basedir, 'uwsgi.pid')
+        self.stats = os.path.join(self.basedir, 'stats.sock')
+        self.fifo = os.path.join(self.basedir, 'master.fifo')
         self.config = utils.merge(
             self.default_config,
             {
-                'chdir': os.path.dirname(os.path.abspath(kwargs['config']['wsgi-file'])),
+                'chdir': os.path.dirname(wsgi_file),
+                'logto': os.path.join(self.basedir, 'uwsgi.log'),
             },
             kwargs['config'],
+            {
+                'wsgi-file': wsgi_file,
+                'stats': self.stats,
+                'master-fifo': self.fifo,
+            },
         )
+        # tunables for load tests
+        for option in ('workers', 'threads', 'listen'):
+            if option in kwargs:
+                self.config[option] = kwargs[option]
+        for option in ('http-socket', 'http', 'socket'):
+            if option in self.config:
+                addr = str(self.config[option])
+                self.address = addr.startswith('/') and addr or addr.rsplit(':', 1)
+                if option != 'socket':  # uwsgi protocol
+                    self.probe = 'http'
+                break
+        self.command = [ self.binary, '--ini', self.configfile ]
 
     def prepare(self):
-        os.makedirs(self.basedir)
+        super(Uwsgi, self).prepare()
         utils.write_ini(self.configfile, { 'uwsgi': self.config })
 
-    def start(self):
-        super(Uwsgi, self).start()
-        pass
+    def read_stats(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.settimeout(1)
+            s.connect(self.stats)
+            data = b''
+            chunk = s.recv(65536)
+            while chunk:
+                data += chunk
+                chunk = s.recv(65536)
+            return json.loads(data.decode('utf-8'))
+        except (socket.error, ValueError):
+            return None
+        finally:
+            s.close()
+
+    def ready_workers(self):
+        # pids of workers ready to accept requests, None until all of them are
+        stats = self.read_stats()
+        if stats is None:
+            return None
+        workers = [ w for w in stats.get('workers', []) if w.get('status') != 'cheap' ]
+        if len(workers) < int(self.config['workers']):
+            return None
+        for w in workers:
+            if not w.get('accepting', w.get('status') in ('idle', 'busy')):
+                return None
+        return set(w['pid'] for w in workers)
+
+    def log_files(self):
+        return [ self.config['logto'] ]
+
+    def is_ready(self):
+        return self.ready_workers() is not None and super(Uwsgi, self).is_ready()
+
+    def fifo_command(self, cmd):
+        # False if master doesn't listen fifo
+        try:
+            fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno in (errno.ENXIO, errno.ENOENT):
+                return False
+            raise
+        try:
+            os.write(fd, cmd.encode('ascii'))
+        finally:
+            os.close(fd)
+        return True
+
+    def reload(self):
+        # chain reload: workers are replaced one by one, no cold restart
+        old = self.ready_workers() or set()
+        assert self.fifo_command('c'), "uwsgi master fifo is not available"
+
+        def replaced():
+            pids = self.ready_workers()
+            return pids is not None and not (pids & old)
+        res = utils.wait_for(replaced, maxtime=self.start_timeout, alive=self.is_running)
+        if not res:
+            raise Exception("uwsgi {0} didn't reload in {1} seconds".format(self.name, self.start_timeout))
+
+    def ctrl(self, *args):
+        if args and args[0] == 'reload':
+            self.reload()
+        elif args and args[0] == 'fifo':
+            self.fifo_command(''.join(args[1:]))
 
     def stop(self):
-        pass
+        # graceful shutdown via fifo, signals if it didn't help
+        if self.fifo_command('q') and utils.wait_exit(self.pid, is_child=True, maxtime=self.stop_timeout):
+            return
+        super(Uwsgi, self).stop()
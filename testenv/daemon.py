@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import os.path
+import socket
+import subprocess
+import sys
+import tempfile
+import traceback
+
+from . import utils
+
+"""
+Warm environments. `testenv serve` starts servers of a config and keeps them
+running, `testenv run` takes environ from the daemon (starting one if needed)
+and runs the command, `testenv stop` shuts the daemon down. Daemons are found
+by config path and reused while the config hash matches; servers are reset
+between runs instead of being restarted. Clients find or spawn the daemon
+under a flock, so concurrent runs never start two daemons for one config.
+Sharded configs are not served, each shard would need an environ of its own.
+"""
+
+
+def socket_path(config):
+    h = hashlib.sha1(config.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), 'testenv-{0}-{1}.sock'.format(utils.user, h))
+
+
+@contextlib.contextmanager
+def locked(path):
+    with contextlib.closing(open(os.path.splitext(path)[0] + '.lock', 'a')) as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+class Channel(object):
+    # json lines over unix socket
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fh = sock.makefile('r')
+
+    def send(self, msg):
+        self.sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+
+    def recv(self):
+        try:
+            line = self.fh.readline()
+        except socket.error:
+            return None
+        return line and json.loads(line) or None
+
+    def close(self):
+        self.fh.close()
+        self.sock.close()
+
+
+def connect(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        return None
+    return Channel(s)
+
+
+def serve(runner):
+    path = socket_path(runner.args.config)
+    runner.config.setdefault('serve_idle_timeout', 3600)
+    runner.setup_signals()
+    listener = None
+    try:
+        runner.setup()
+        listener = utils.listen_socket(path)
+        listener.settimeout(runner.config['serve_idle_timeout'] or None)
+        sys.stderr.write("Serving {0} at {1}\n".format(runner.args.config, path))
+        sys.stderr.flush()
+        used = False
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                sys.stderr.write("Idle for {0}s, exiting\n".format(runner.config['serve_idle_timeout']))
+                break
+            conn.settimeout(None)
+            ch = Channel(conn)
+            try:
+                msg = ch.recv()
+                if msg is None:
+                    continue
+                if msg['op'] == 'stop':
+                    ch.send({ 'ok': True, 'pid': os.getpid() })
+                    break
+                alive = all(s.is_running() for s in runner.servers.values())
+                if msg.get('hash') != runner.config_hash or not alive:
+                    ch.send({ 'ok': False, 'stale': True, 'pid': os.getpid() })
+                    break
+                try:
+                    if used:
+                        runner.reset_servers()
+                except Exception as e:
+                    traceback.print_exc(file=sys.stderr)
+                    ch.send({ 'ok': False, 'stale': True, 'pid': os.getpid(), 'error': str(e) })
+                    break
+                used = True
+                ch.send({ 'ok': True, 'environ': dict((k, str(v)) for k, v in runner.environ.items()) })
+                ch.recv()  # environment is held until the client disconnects
+            finally:
+                ch.close()
+        runner.exit_code = 0
+    except Exception:
+        traceback.print_exc(limit=100, file=sys.stderr)
+    finally:
+        if listener is not None:
+            listener.close()
+            os.unlink(path)
+        runner.teardown()
+
+
+def spawn(runner, path):
+    argv = [ sys.executable, sys.argv[0], 'serve', '--config', runner.args.config ]
+    if runner.args.concurrency is not None:
+        argv += [ '--concurrency', str(runner.args.concurrency) ]
+    if not runner.args.template_cache:
+        argv.append('--no-template-cache')
+    log = open(os.path.splitext(path)[0] + '.log', 'a')
+    devnull = open(os.devnull, 'r')
+    p = subprocess.Popen(argv, stdin=devnull, stdout=log, stderr=log, close_fds=True, preexec_fn=os.setsid)
+    sys.stderr.write("Started testenv daemon, pid = {0}, log = {1}\n".format(p.pid, log.name))
+    if not utils.wait_for_socket(path, maxtime=runner.config.get('serve_start_timeout', 600),
+                                 alive=lambda: p.poll() is None):
+        raise Exception("testenv daemon didn't start, see " + log.name)
+
+
+def wait_exit(reply):
+    # previous daemon should free basedir and ports before a new one starts
+    if reply and reply.get('pid'):
+        utils.wait_for(lambda: not utils.is_running(reply['pid']), maxtime=60)
+
+
+def acquire(runner):
+    path = socket_path(runner.args.config)
+    with locked(path):
+        return acquire_locked(runner, path)
+
+
+def acquire_locked(runner, path):
+    for attempt in range(2):
+        ch = connect(path)
+        if ch is None:
+            spawn(runner, path)
+            ch = connect(path)
+        if ch is None:
+            raise Exception("can't connect to testenv daemon at " + path)
+        ch.send({ 'op': 'acquire', 'hash': runner.config_hash })
+        reply = ch.recv()
+        if reply and reply['ok']:
+            return ch, reply['environ']
+        ch.close()
+        if reply is None or not reply.get('stale'):
+            raise Exception("testenv daemon failed: " + (reply and reply.get('error') or 'connection lost'))
+        sys.stderr.write("testenv daemon is stale, restarting\n")
+        wait_exit(reply)
+    raise Exception("can't get fresh testenv daemon")
+
+
+def stop(runner):
+    path = socket_path(runner.args.config)
+    with locked(path):
+        ch = connect(path)
+        if ch is None:
+            return
+        ch.send({ 'op': 'stop' })
+        wait_exit(ch.recv())
+        ch.close()
+
+
+def main(runner):
+    mode = runner.args.mode
+    try:
+        if mode in ('serve', 'run'):
+            # every shard is an environment of its own, a daemon hands out one environ
+            assert runner.config['shards'] == 1, "shards are supported by one-shot runs only"
+        if mode == 'serve':
+            serve(runner)
+        elif mode == 'stop':
+            stop(runner)
+            runner.exit_code = 0
+        elif mode == 'run':
+            ch, runner.environ = acquire(runner)
+            try:
+                runner.run_command()
+            finally:
+                ch.close()
+    except Exception:
+        traceback.print_exc(limit=100, file=sys.stderr)
+    sys.exit(runner.exit_code)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import contextlib
+import os
+import os.path
+import sys
+
+import yaml
+
+from . import runner
+
+"""
+testenv embedded into a python process (test session, script, notebook):
+the same setup and teardown as the command line runner, but no argv,
+no signal handlers, no stdio redirection and no sys.exit.
+
+    with Environment('testenv.yml', basedir='TEMP') as env:
+        connect(env.environ['mysql_sock'])
+"""
+
+
+class Environment(object):
+
+    def __init__(self, config, confdir=None, **options):
+        # config: path to yaml or a dict; options override its top level keys
+        if isinstance(config, dict):
+            path = None
+            config = dict(config)
+            confdir = confdir or os.getcwd()
+        else:
+            path = os.path.abspath(config)
+            with contextlib.closing(open(path, "r")) as fh:
+                config = yaml.load(fh)
+            confdir = confdir or os.path.dirname(path)
+        config.update(options)
+        self.config = config
+        self.runner = runner.Runner()
+        self.runner.embedded = True
+        self.runner.confdir = os.path.abspath(confdir)
+        self.runner.args = argparse.Namespace(config=path, mode=None, command=[], concurrency=None, shards=None,
+                                              timings=False, monitor=None, template_cache=True)
+        self.started = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        assert not self.started, "environment is already started"
+        r = self.runner
+        if r.confdir not in sys.path:
+            sys.path.append(r.confdir)  # server types next to config
+        with r.tracer.span('read_config'):
+            r.read_config(self.config)
+        assert r.config['shards'] == 1, "shards are supported by command line runner only"
+        self.started = True
+        try:
+            r.setup()
+            r.start_monitor()
+            r.start_supervisor()
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        if not self.started:
+            return
+        r = self.runner
+        try:
+            r.stop_supervisor()
+            r.stop_monitor()
+        finally:
+            self.started = False
+            r.teardown()
+
+    @property
+    def environ(self):
+        # generated variables: $name_addr$, $name_port$, basedir, ...
+        return dict((k, str(v)) for k, v in self.runner.environ.items())
+
+    def export(self):
+        # makes environ visible to code reading os.environ, returns what should be restored
+        saved = dict((k, os.environ.get(k)) for k in self.environ)
+        os.environ.update(self.environ)
+        return saved
+
+    @property
+    def servers(self):
+        return self.runner.servers
+
+    @property
+    def basedir(self):
+        return self.runner.basedir
+
+    @property
+    def crashed(self):
+        # a server with on_crash: abort died
+        return self.runner.crashed
+
+    def server(self, name):
+        assert name in self.runner.servers, "no such server " + name
+        return self.runner.servers[name]
+
+    def address(self, name):
+        return self.server(name).address
+
+    def stop_server(self, name):
+        self.runner.stop_server(self.server(name))
+
+    def start_server(self, name):
+        self.runner.respawn_server(self.server(name))
+
+    def restart_server(self, name):
+        self.stop_server(name)
+        self.start_server(name)
+
+    def reset(self):
+        # data of every server back to the state right after fill
+        self.runner.reset_servers()
+
+    def checkpoint(self, name='default'):
+        with self.runner.tracer.span('checkpoint'):
+            self.runner.checkpoint(name)
+
+    def has_checkpoint(self, name='default'):
+        return os.path.isdir(self.runner.checkpoint_path(name))
+
+    def rollback(self, name='default'):
+        # state of checkpoint back, only changed servers are restarted; returns their names
+        with self.runner.tracer.span('rollback'):
+            return self.runner.rollback(name)
+
+    def ctrl(self, name, *args):
+        return self.server(name).ctrl(*args)
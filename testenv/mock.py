@@ -1,11 +1,325 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import contextlib
+import io
+import json
+import math
+import multiprocessing
 import os
+import random
+import re
 import signal
+import socket
+import struct
 import sys
-from wsgiref.simple_server import make_server
+import threading
+import time
+import traceback
+from wsgiref import simple_server
 
-from . import server
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import gevent
+    from gevent import pywsgi as gevent_pywsgi
+except ImportError:
+    gevent = gevent_pywsgi = None
+
+from . import server, utils
+
+
+class InjectedReset(Exception):
+    pass  # application asks to reset the connection
+
+
+class ServerHandler(simple_server.ServerHandler):
+
+    http_version = '1.1'
+
+    def handle_error(self):
+        if isinstance(sys.exc_info()[1], InjectedReset):
+            self.request_handler.reset_connection = True
+            return
+        simple_server.ServerHandler.handle_error(self)
+
+    def cleanup_headers(self):
+        simple_server.ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers:
+            self.request_handler.close_connection = True  # no other way to mark end of response
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class KeepAliveHandler(simple_server.WSGIRequestHandler):
+    """
+    HTTP/1.1 handler, serves requests of a connection until client
+    or response asks to close it.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = 30  # idle keep-alive connections hold a worker
+    reset_connection = False
+
+    def setup(self):
+        # headers and body are written separately, don't wait for delayed ack
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        simple_server.WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_request()
+        while not self.close_connection:
+            self.handle_request()
+
+    def handle_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        if 'chunked' in (self.headers.get('Transfer-Encoding') or ''):
+            self.close_connection = True
+        # body is read in advance, so unread by application one can't break next request
+        body = io.BytesIO(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+        handler = ServerHandler(body, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if self.reset_connection:
+            # zero linger makes close() send RST
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+
+
+class PooledWSGIServer(simple_server.WSGIServer):
+    # connections are served by a fixed pool of threads
+
+    def start_pool(self, threads):
+        self.requests = queue.Queue()
+        for i in range(threads):
+            t = threading.Thread(target=self.pool_worker)
+            t.daemon = True
+            t.start()
+
+    def pool_worker(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+
+class Route(object):
+    """
+    Faults injected into responses matching path regex (and method):
+    latency in ms - number or { dist: fixed, value } / { dist: uniform, min, max } /
+    { dist: lognormal, median, sigma }, bandwidth of response body in bytes/s,
+    error_rate with error_status, reset_rate of connection resets.
+    """
+
+    BUCKETS = [ 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000 ]  # ms
+
+    def __init__(self, path='', method=None, latency=None, bandwidth=None, error_rate=0, error_status=503,
+                 reset_rate=0):
+        self.name = (method and method + ' ' or '') + (path or '*')
+        self.path = re.compile(path)
+        self.method = method
+        if isinstance(latency, (int, float)):
+            latency = { 'dist': 'fixed', 'value': latency }
+        self.latency = latency
+        assert latency is None or latency.get('dist') in ('fixed', 'uniform', 'lognormal'), \
+            "latency dist should be fixed, uniform or lognormal"
+        self.bandwidth = bandwidth and utils.parse_size(bandwidth)
+        self.error_rate = float(error_rate)
+        self.error_status = str(error_status)
+        if ' ' not in self.error_status:
+            reason = simple_server.WSGIRequestHandler.responses.get(int(error_status), ('Error',))[0]
+            self.error_status += ' ' + reason
+        self.reset_rate = float(reset_rate)
+        self.count = 0
+        self.statuses = {}
+        self.histogram = [ 0 ] * (len(self.BUCKETS) + 1)
+
+    def match(self, environ):
+        if self.method is not None and environ['REQUEST_METHOD'] != self.method:
+            return False
+        return self.path.search(environ.get('PATH_INFO', '')) is not None
+
+    def delay(self):
+        lat = self.latency
+        if lat is None:
+            return 0
+        if lat['dist'] == 'fixed':
+            ms = lat['value']
+        elif lat['dist'] == 'uniform':
+            ms = random.uniform(lat['min'], lat['max'])
+        else:
+            ms = random.lognormvariate(math.log(lat['median']), lat.get('sigma', 0.5))
+        return ms / 1000.0
+
+    def record(self, status, elapsed):
+        self.count += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.histogram[bisect.bisect_left(self.BUCKETS, elapsed * 1000)] += 1
+
+    def stats(self):
+        buckets = [ str(b) for b in self.BUCKETS ] + [ 'inf' ]
+        return { 'count': self.count, 'statuses': self.statuses, 'latency_ms': dict(zip(buckets, self.histogram)) }
+
+
+class FaultInjector(object):
+    """
+    WSGI middleware: injects faults of the first matching route, counts
+    requests and latencies per route, serves stats as json on stats_path.
+    Connection resets need threaded or prefork backend.
+    """
+
+    def __init__(self, application, routes=(), stats_path=None, dump_path=None, sleep=time.sleep):
+        self.application = application
+        self.routes = [ Route(**r) for r in routes ] + [ Route() ]  # catch-all
+        self.stats_path = stats_path
+        self.dump_path = dump_path
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.stats_path:
+            body = json.dumps(self.stats(), indent=1).encode('utf-8')
+            start_response('200 OK', [ ('Content-Type', 'application/json'), ('Content-Length', str(len(body))) ])
+            return [ body ]
+        started = time.time()
+        route = [ r for r in self.routes if r.match(environ) ][0]
+        self.sleep(route.delay())
+        if route.reset_rate and random.random() < route.reset_rate:
+            self.record(route, 'reset', started)
+            raise InjectedReset()
+        if route.error_rate and random.random() < route.error_rate:
+            self.record(route, route.error_status.split()[0], started)
+            body = b'injected error\n'
+            start_response(route.error_status, [ ('Content-Type', 'text/plain'),
+                                                 ('Content-Length', str(len(body))) ])
+            return [ body ]
+        status = []
+
+        def start(s, headers, exc_info=None):
+            status.append(s.split()[0])
+            return start_response(s, headers, exc_info)
+        result = self.application(environ, start)
+        if not route.bandwidth and isinstance(result, (list, tuple)):
+            # keep it a list, so the server may set Content-Length and keep connection alive
+            self.record(route, status and status[-1] or 'none', started)
+            return result
+        return self.respond(route, result, status, started)
+
+    def respond(self, route, result, status, started):
+        try:
+            for chunk in result:
+                if not route.bandwidth:
+                    yield chunk
+                    continue
+                step = max(1, route.bandwidth // 10)
+                for i in range(0, len(chunk), step):
+                    yield chunk[i:i + step]
+                    self.sleep(len(chunk[i:i + step]) / float(route.bandwidth))
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            self.record(route, status and status[-1] or 'none', started)
+
+    def record(self, route, status, started):
+        with self.lock:
+            route.record(status, time.time() - started)
+
+    def stats(self):
+        with self.lock:
+            return dict((r.name, r.stats()) for r in self.routes if r.count)
+
+    def dump(self):
+        if self.dump_path is None:
+            return
+        path = self.dump_path
+        if os.getpid() != self.pid:
+            # every prefork worker has its own stats
+            path = '{0}.{1}{2}'.format(os.path.splitext(path)[0], os.getpid(), os.path.splitext(path)[1])
+        with contextlib.closing(open(path, 'w')) as fh:
+            json.dump(self.stats(), fh, indent=1)
+
+
+def make_wsgi_server(application, sock, server_class=simple_server.WSGIServer,
+                     handler_class=simple_server.WSGIRequestHandler):
+    # server on already listening socket
+    httpd = server_class(sock.getsockname(), handler_class, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = sock
+    httpd.server_address = sock.getsockname()
+    httpd.server_name, httpd.server_port = httpd.server_address[:2]
+    httpd.setup_environ()
+    httpd.set_app(application)
+    return httpd
+
+
+def serve_simple(application, sock, workers, threads):
+    # single threaded wsgiref, one request per connection
+    make_wsgi_server(application, sock).serve_forever()
+
+
+def serve_threaded(application, sock, workers, threads):
+    httpd = make_wsgi_server(application, sock, PooledWSGIServer, KeepAliveHandler)
+    httpd.start_pool(threads)
+    httpd.serve_forever()
+
+
+def serve_prefork(application, sock, workers, threads):
+    # worker processes with thread pools accept on the shared socket
+    pids = []
+    try:
+        for i in range(workers or multiprocessing.cpu_count()):
+            pid = os.fork()
+            if not pid:
+                try:
+                    serve_threaded(application, sock, workers, threads)
+                finally:
+                    if isinstance(application, FaultInjector):
+                        application.dump()
+                    os._exit(0)
+            pids.append(pid)
+        while pids:
+            pids.remove(os.wait()[0])
+    finally:
+        for pid in pids:
+            utils.stop_with_signal(pid, is_child=True)
+
+
+def serve_gevent(application, sock, workers, threads):
+    assert gevent_pywsgi is not None, "gevent backend requires gevent package"
+    gevent_pywsgi.WSGIServer(sock, application).serve_forever()
+
+
+BACKENDS = {
+    'simple': serve_simple,
+    'threaded': serve_threaded,
+    'prefork': serve_prefork,
+    'gevent': serve_gevent,
+}
 
 
 class Mock(server.GenericServer):
@@ -15,13 +329,29 @@ class Mock(server.GenericServer):
         super(Mock, self).init(**kwargs)
 
     def start(self):
+        if self.socket_activation:
+            self.bind_sockets()  # clients may connect before the child is up
         pid = os.fork()
         if pid:
             self.pid = pid
         else:
-            self.setup_signals()
-            self.open_log()
-            self.run()
+            # servers may be started from runner threads, child should never
+            # get back into the runner code
+            code = 0
+            try:
+                utils.close_fds([ s.fileno() for s in self.sockets ])
+                self.setup_signals()
+                self.open_log()
+                self.run()
+            except SystemExit as e:
+                code = e.code or 0
+            except BaseException:
+                traceback.print_exc(file=sys.stderr)
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
 
     def run():
         raise Exception("should be implemented")
@@ -47,14 +377,32 @@ class HttpMock(Mock):
     application = None
     ip = ''
     port = None
+    probe = 'http'
+    backend = 'threaded'
+    workers = None  # processes of prefork backend, cpu count by default
+    threads = 16    # threads of threaded and prefork backends
+    backlog = 128
+    routes = ()     # faults, see Route
+    stats_path = '/_testenv/stats'
 
     def init(self, **kwargs):
         super(HttpMock, self).init(**kwargs)
         assert self.application is not None, "application attribute should be defined"
         assert self.port is not None, "port attribute should be defined"
+        assert self.backend in BACKENDS, "backend should be one of: " + ', '.join(sorted(BACKENDS))
         self.port = int(self.port)
         self.address = (self.ip, self.port)
+        self.listen_backlog = int(self.backlog)
+        if self.probe == 'http':
+            # stats are answered by FaultInjector itself: the probe neither hits the app nor shows up in stats
+            self.probe = { 'type': 'http', 'path': self.stats_path }
 
     def run(self):
-        httpd = make_server(self.ip, self.port, self.application)
-        httpd.serve_forever()
+        sock = self.sockets and self.sockets[0] or utils.listen_socket(self.address, self.listen_backlog)
+        sleep = self.backend == 'gevent' and gevent.sleep or time.sleep
+        app = FaultInjector(self.application, self.routes, self.stats_path,
+                            self.basepath(self.name + '.stats.json'), sleep)
+        try:
+            BACKENDS[self.backend](app, sock, self.workers and int(self.workers), int(self.threads))
+        finally:
+            app.dump()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import json
+import os
+import os.path
+import threading
+
+from . import utils
+
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_file(path):
+    try:
+        with contextlib.closing(open(path, 'r')) as fh:
+            return fh.read()
+    except (IOError, OSError):
+        return None  # process is gone or not ours
+
+
+def proc_stat(pid):
+    # (ppid, cpu seconds, rss bytes) from /proc/<pid>/stat
+    data = read_file('/proc/{0}/stat'.format(pid))
+    if data is None:
+        return None
+    fields = data[data.rindex(')') + 2:].split()  # comm may contain spaces
+    return int(fields[1]), (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS), int(fields[21]) * PAGE_SIZE
+
+
+def proc_io(pid):
+    data = read_file('/proc/{0}/io'.format(pid)) or ''
+    io = dict(line.split(': ', 1) for line in data.splitlines() if ': ' in line)
+    return int(io.get('read_bytes', 0)), int(io.get('write_bytes', 0))
+
+
+def proc_fds(pid):
+    try:
+        return len(os.listdir('/proc/{0}/fd'.format(pid)))
+    except OSError:
+        return 0
+
+
+class Usage(object):
+    # peak and average of per server samples
+
+    def __init__(self):
+        self.samples = 0
+        self.peak = {}
+        self.total = {}
+        self.last_cpu = None
+
+    def add(self, sample):
+        self.samples += 1
+        for k in ('cpu', 'rss', 'fds'):
+            self.peak[k] = max(self.peak.get(k, 0), sample[k])
+            self.total[k] = self.total.get(k, 0) + sample[k]
+        for k in ('read_bytes', 'write_bytes'):
+            self.peak[k] = max(self.peak.get(k, 0), sample[k])
+
+    def avg(self, k):
+        return self.samples and self.total[k] / float(self.samples) or 0
+
+
+class Monitor(object):
+    """
+    Samples cpu, rss, open fds and disk io of every server process tree from
+    /proc on a background thread. Samples go to a json lines file, peak and
+    average usage is checked against per server limits at the end.
+    """
+
+    def __init__(self, servers, interval=1.0, path=None):
+        self.servers = servers  # { label: server }
+        self.interval = interval
+        self.path = path
+        self.usage = dict((label, Usage()) for label in servers)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.out = None
+
+    def start(self):
+        if self.path is not None:
+            self.out = open(self.path, 'w')
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.out is not None:
+            self.out.close()
+
+    def loop(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def sample(self):
+        now = utils.monotonic()
+        stats = {}
+        children = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                stat = proc_stat(int(entry))
+                if stat is not None:
+                    stats[int(entry)] = stat
+                    children.setdefault(stat[0], []).append(int(entry))
+        for label, server in self.servers.items():
+            if server.pid is None or server.pid not in stats:
+                continue
+            sample = { 't': now, 'server': label, 'cpu': 0, 'rss': 0, 'fds': 0, 'read_bytes': 0, 'write_bytes': 0 }
+            cpu_time = 0
+            tree = [ server.pid ]
+            while tree:
+                pid = tree.pop()
+                tree.extend(children.get(pid, []))
+                cpu_time += stats[pid][1]
+                sample['rss'] += stats[pid][2]
+                sample['fds'] += proc_fds(pid)
+                read_bytes, write_bytes = proc_io(pid)
+                sample['read_bytes'] += read_bytes
+                sample['write_bytes'] += write_bytes
+            usage = self.usage[label]
+            if usage.last_cpu is not None and now > usage.last_cpu[0]:
+                sample['cpu'] = 100 * (cpu_time - usage.last_cpu[1]) / (now - usage.last_cpu[0])
+            usage.last_cpu = (now, cpu_time)
+            usage.add(sample)
+            if self.out is not None:
+                self.out.write(json.dumps(sample) + '\n')
+        if self.out is not None:
+            self.out.flush()
+
+    def report(self):
+        lines = [ "Resource usage (peak / avg):" ]
+        for label in sorted(self.usage):
+            u = self.usage[label]
+            if not u.samples:
+                continue
+            lines.append("  {0}: cpu {1:.0f}% / {2:.0f}%, rss {3:.1f}M / {4:.1f}M, fds {5} / {6:.0f},"
+                         " io read {7:.1f}M write {8:.1f}M".format(
+                             label, u.peak['cpu'], u.avg('cpu'), u.peak['rss'] / 1048576.0, u.avg('rss') / 1048576.0,
+                             u.peak['fds'], u.avg('fds'),
+                             u.peak['read_bytes'] / 1048576.0, u.peak['write_bytes'] / 1048576.0))
+        return '\n'.join(lines) + '\n'
+
+    def violations(self):
+        res = []
+        for label, server in sorted(self.servers.items()):
+            u = self.usage[label]
+            for k, limit in sorted((server.limits or {}).items()):
+                limit = k == 'rss' and utils.parse_size(limit) or float(limit)
+                if u.peak.get(k, 0) > limit:
+                    res.append("{0}: {1} peak {2} is over limit {3}".format(label, k, u.peak[k], limit))
+        return res
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import select
+import socket
+import struct
+
+from . import utils
+
+"""
+Readiness probes. A probe keeps one non-blocking connection between
+attempts: it connects, sends its request once and then only reads what
+has already arrived, so check() never blocks and never reconnects while
+the server is just slow to answer.
+"""
+
+
+class Probe(object):
+
+    request = None
+
+    def __init__(self, address, **options):
+        self.address = address
+        self.options = options
+        self.sock = None
+        self.connected = False
+        self.buffer = b''
+
+    def open(self):
+        family, addr = utils.parse_address(self.address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK):
+            raise socket.error(err, "connect failed")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+        self.buffer = b''
+
+    def check(self):
+        try:
+            if self.sock is None:
+                self.open()
+            if not self.connected:
+                _, w, _ = select.select([], [self.sock], [], 0)
+                if not w:
+                    return False
+                err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise socket.error(err, "connect failed")
+                self.connected = True
+                if self.request is not None:
+                    self.sock.sendall(self.get_request())
+            closed = False
+            while True:
+                try:
+                    chunk = self.sock.recv(4096)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                if not chunk:
+                    closed = True
+                    break
+                self.buffer += chunk
+            res = self.parse(self.buffer)
+            if res is None and not closed:
+                return False  # answer is not complete yet
+            if not res or closed:
+                self.close()  # try again with a new connection
+            return bool(res)
+        except socket.error:
+            self.close()
+            return False
+
+    def get_request(self):
+        return self.request
+
+    def parse(self, data):
+        # True - ready, False - server answered it isn't, None - wait more
+        return True
+
+
+class ConnectProbe(Probe):
+    pass  # accepted connection is enough
+
+
+class MySQLProbe(Probe):
+    # initial handshake packet, protocol 10; 0xff is error (too many connections, etc)
+
+    def parse(self, data):
+        if len(data) < 5:
+            return None
+        length = struct.unpack('<I', data[:3] + b'\0')[0]
+        if len(data) < 4 + length:
+            return None
+        return data[4:5] == b'\x0a'
+
+
+class TarantoolProbe(Probe):
+
+    def parse(self, data):
+        if b'\n' not in data:
+            return None
+        return data.startswith(b'Tarantool ')
+
+
+class RedisProbe(Probe):
+    # -LOADING while dataset is loaded
+
+    request = b'PING\r\n'
+
+    def parse(self, data):
+        if b'\r\n' not in data:
+            return None
+        return data.startswith(b'+PONG')
+
+
+class MemcachedProbe(Probe):
+
+    request = b'version\r\n'
+
+    def parse(self, data):
+        if b'\r\n' not in data:
+            return None
+        return data.startswith(b'VERSION ')
+
+
+class HttpProbe(Probe):
+    # options: path (default /), any status below 500 is ready
+
+    def get_request(self):
+        return 'GET {0} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format(self.options.get('path', '/')).encode('ascii')
+
+    request = True
+
+    def parse(self, data):
+        if b'\r\n' not in data:
+            return None
+        status = data.split(b'\r\n', 1)[0].split()
+        return len(status) > 1 and status[0].startswith(b'HTTP/') and status[1].isdigit() and int(status[1]) < 500
+
+
+PROBES = {
+    'connect': ConnectProbe,
+    'mysql': MySQLProbe,
+    'tarantool': TarantoolProbe,
+    'redis': RedisProbe,
+    'memcached': MemcachedProbe,
+    'http': HttpProbe,
+}
+
+
+def register(name, cls):
+    PROBES[name] = cls
+
+
+def make(spec, address):
+    # spec: probe name or { type: name, option: value }
+    if isinstance(spec, dict):
+        options = dict(spec)
+        name = options.pop('type')
+    else:
+        name, options = spec, {}
+    assert name in PROBES, "unknown probe " + str(name)
+    return PROBES[name](address, **options)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+
+import pytest
+
+from .environment import Environment
+from .runner import Runner
+
+"""
+pytest plugin: one environment per test session, shared by all modules.
+
+    pytest --testenv-config testenv.yml
+
+or `testenv_config = testenv.yml` in the ini file. Tests take the `testenv`
+fixture (an Environment); generated variables are also exported to
+os.environ for the session. Every xdist worker gets its own environment,
+with `-<worker id>` appended to the configured basedir.
+Tests taking `testenv_isolated` instead have the environment rolled back
+to the state before the first of them after each test.
+"""
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('testenv')
+    group.addoption('--testenv-config', dest='testenv_config', default=None,
+                    help='testenv config (.yml) started once for the session')
+    parser.addini('testenv_config', 'testenv config (.yml) started once for the session', default=None)
+
+
+def config_path(config):
+    path = config.getoption('testenv_config')
+    if path:
+        return os.path.abspath(path)
+    path = config.getini('testenv_config')
+    if path:
+        return os.path.join(str(config.rootdir), path)
+    return None
+
+
+@pytest.fixture(scope='session')
+def testenv(request):
+    path = config_path(request.config)
+    if path is None:
+        pytest.skip("no testenv config, use --testenv-config or testenv_config ini option")
+    env = Environment(path)
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    basedir = env.config.get('basedir', 'tenv')
+    if worker and basedir != Runner.BASEDIR_TEMP:
+        env.config['basedir'] = basedir.rstrip('/') + '-' + worker
+    with env:
+        saved = env.export()
+        try:
+            yield env
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+
+@pytest.fixture
+def testenv_isolated(testenv):
+    if not testenv.has_checkpoint('pytest'):
+        testenv.checkpoint('pytest')
+    yield testenv
+    testenv.rollback('pytest')
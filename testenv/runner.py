@@ -2,9 +2,9 @@
 
 import argparse
 import contextlib
+import copy
 import os.path
 import re
-import shutil
 import signal
 import subprocess
 import sys
@@ -13,7 +13,7 @@ import traceback
 
 import yaml
 
-from . import utils
+from . import cache, daemon, monitor, supervisor, trace, trash, utils
 
 """
 Main code, runner
@@ -23,6 +23,10 @@ Main code, runner
 class Runner(object):
 
     BASEDIR_TEMP = 'TEMP'
+    MEMORY_DIRS = ('/dev/shm', '/run/shm')  # for ephemeral basedirs
+    MODES = ('serve', 'run', 'stop')  # see daemon.py
+
+    embedded = False  # inside a foreign process (environment.py): stdio and signals are not ours
 
     signals = [
         signal.SIGINT,
@@ -35,8 +39,17 @@ class Runner(object):
         self.config = {}     # parsed config
         self.environ = {}    # generated vars
         self.servers = {}    # server instances
+        self.shards = []     # isolated copies of env (runners)
         self.basedir = None  # dir with temporary env
+        self.ports = utils.PortLease()  # host wide leased ports
+        self.cache = None    # templates cache shared by runs
         self.confdir = None  # dir with config
+        self.config_hash = None
+        self.tracer = trace.Tracer()  # phases timing
+        self.monitor = None  # resources sampler
+        self.supervisor = None  # crash watcher while the command runs
+        self.commands = []
+        self.crashed = False
         self.pid = os.getpid()
         self.exit_code = 1   # error by default
         self.orig_stderr = sys.stderr
@@ -45,21 +58,61 @@ class Runner(object):
     def parse_params(self):
         parser = argparse.ArgumentParser(description='Process some integers.')
         parser.add_argument('--config', dest='config', type=str, help='testenv config (.yml)', required=True)
+        parser.add_argument('--concurrency', dest='concurrency', type=int, default=None,
+                            help='max servers started at once (0 - no limit)')
+        parser.add_argument('--shards', dest='shards', type=int, default=None,
+                            help='number of isolated environment copies, command is run once per shard')
+        parser.add_argument('--timings', dest='timings', action='store_true', default=False,
+                            help='print the slowest phases at exit')
+        parser.add_argument('--monitor', dest='monitor', type=float, default=None, metavar='INTERVAL',
+                            help='sample servers resource usage every INTERVAL seconds')
+        parser.add_argument('--no-template-cache', dest='template_cache', action='store_false', default=True,
+                            help='do not use cached server templates')
         parser.add_argument('command', nargs=argparse.REMAINDER)
-        args = parser.parse_args()
+        argv = sys.argv[1:]
+        mode = argv and argv[0] in self.MODES and argv.pop(0) or None
+        args = parser.parse_args(argv)
+        args.mode = mode
         args.config = os.path.abspath(args.config)
         if not os.path.isfile(args.config):
             raise Exception("not a file: " + args.config)
         self.confdir = os.path.dirname(args.config)
         self.args = args
 
-    def read_config(self):
-        with contextlib.closing(open(self.args.config, "r")) as fh:
-            self.config = yaml.load(fh)
+    def read_config(self, config=None):
+        if config is None:
+            with contextlib.closing(open(self.args.config, "r")) as fh:
+                config = yaml.load(fh)
+        self.config = copy.deepcopy(config)
+        # daemons are matched by the config as written plus the options daemon.spawn forwards,
+        # command line options the daemon doesn't take (monitor, timings) shouldn't make it stale
+        self.config_hash = cache.make_key(self.args.config, self.config, self.args.concurrency,
+                                          self.args.template_cache)
         self.config.setdefault('basedir', 'tenv')
         self.config.setdefault('basedir_cleanup', False)
         self.config.setdefault('servers', {})
         self.config.setdefault('log', None)
+        self.config.setdefault('ephemeral', False)
+        self.config.setdefault('trace', 'trace.json')
+        self.config.setdefault('monitor', None)
+        if self.args.monitor is not None:
+            self.config['monitor'] = { 'interval': self.args.monitor }
+        if self.config['monitor'] is True:
+            self.config['monitor'] = {}
+        self.config.setdefault('concurrency', 0)
+        if self.args.concurrency is not None:
+            self.config['concurrency'] = self.args.concurrency
+        self.config.setdefault('shards', 1)
+        if self.args.shards is not None:
+            self.config['shards'] = self.args.shards
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        self.config.setdefault('cache_dir', os.path.join(cache_home, 'testenv'))
+        self.config.setdefault('cache_size', '4G')
+        self.config.setdefault('trash_size', '8G')
+        self.config.setdefault('supervise', True)
+        self.config.setdefault('template_cache', True)
+        if not self.args.template_cache:
+            self.config['template_cache'] = False
         assert type(self.config['servers']) == dict, "servers section should be a dict"
         for name, sconf in self.config['servers'].iteritems():
             assert 'type' in sconf, name + " should have type attribute"
@@ -82,7 +135,7 @@ class Runner(object):
                 kind = groups[2]
                 if kind in ('addr', 'ip', 'port'):
                     ip = utils.free_ip()
-                    port = utils.free_port(ip)
+                    port = self.ports.port(ip)
                     addr = '{0}:{1}'.format(ip, port)
                     environ.setdefault(sname + '_ip', ip)
                     environ.setdefault(sname + '_port', port)
@@ -127,6 +180,8 @@ class Runner(object):
             return os.path.join(self.basedir, path)
 
     def open_log(self):
+        if self.embedded:
+            return
         self.orig_stderr = os.fdopen(os.dup(sys.stderr.fileno()), 'w')
         self.orig_stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
         if self.config['log'] is not None:
@@ -134,15 +189,49 @@ class Runner(object):
             os.dup2(log.fileno(), sys.stderr.fileno())
             os.dup2(log.fileno(), sys.stdout.fileno())
 
+    def memory_dir(self):
+        for d in self.MEMORY_DIRS:
+            if os.path.isdir(d) and os.access(d, os.W_OK):
+                return d
+        sys.stderr.write("No memory backed dir found, ephemeral basedir is on disk\n")
+        return None
+
+    def remove_basedir(self):
+        if os.path.islink(self.basedir):
+            target = os.path.realpath(self.basedir)
+            os.unlink(self.basedir)
+            if os.path.isdir(target):
+                trash.dispose(target, self.trash_size())
+        elif os.path.exists(self.basedir):
+            trash.dispose(self.basedir, self.trash_size())
+
+    def trash_size(self):
+        return utils.parse_size(self.config['trash_size'])
+
     def create_basedir(self):
         basedir = self.config['basedir']
+        memdir = self.config['ephemeral'] and self.memory_dir() or None
         if basedir == self.BASEDIR_TEMP:
-            self.basedir = tempfile.mkdtemp()
+            self.basedir = tempfile.mkdtemp(dir=memdir)
         else:
             self.basedir = os.path.join(self.confdir, basedir)
-            if os.path.exists(self.basedir):
-                shutil.rmtree(self.basedir)
-            os.makedirs(self.basedir)
+            self.remove_basedir()
+            parent = os.path.realpath(os.path.dirname(self.basedir))
+            if memdir is not None and not parent.startswith(memdir):
+                # keep configured path as a link to the memory backed dir
+                os.symlink(tempfile.mkdtemp(prefix='testenv-', dir=memdir), self.basedir)
+            else:
+                os.makedirs(self.basedir)
+        # orphans of collectors killed before they finished
+        for path in set([ self.basedir, os.path.realpath(self.basedir) ]):
+            trash.collect(trash.location(path), self.trash_size())
+
+    def create_cache(self):
+        if self.config['template_cache']:
+            root = self.confpath(os.path.expanduser(self.config['cache_dir']))
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            self.cache = cache.Cache(root, utils.parse_size(self.config['cache_size']))
 
     def create_servers(self):
         for name, sconf in self.config['servers'].iteritems():
@@ -153,35 +242,87 @@ class Runner(object):
             self.servers[name] = sclass(self, name, sconf)
 
     def order_servers(self):
-        ordered = []
-        stack = []
-
-        def add(server):
-            if server in stack:
-                bad = ', '.join(s.name for s in stack)
-                raise Exception("dependency cycle with servers: " + bad)
-            stack.append(server)
+        for server in self.servers.values():
             for s in server.after:
                 if s not in self.servers:
                     raise Exception("wrong dependency {0}: no such server".format(s))
-                add(self.servers[s])
-            if server not in ordered:
-                ordered.append(server)
-            stack.pop()
-        for s in self.servers.values():
-            add(s)
-        return ordered
+        return utils.order_graph(self.servers.values(), self.server_deps, 'servers', lambda s: s.name)
+
+    def server_deps(self, server):
+        return [ self.servers[s] for s in server.after ]
+
+    def start_server(self, server):
+        sys.stderr.write("Starting {0}\n".format(server.name))
+        for phase in (server.prepare, server.start, server.wait_ready, server.fill):
+            with self.tracer.span(server.name + '.' + phase.__name__, 'server', server=server.name):
+                phase()
 
     def start_servers(self):
+        servers = self.order_servers()
+        errors = utils.run_graph(servers, self.server_deps, self.start_server, workers=self.config['concurrency'])
+        if errors:
+            utils.report_errors(servers, errors, 'start')
+
+    def reset_server(self, server):
+        with self.tracer.span(server.name + '.reset', 'server', server=server.name):
+            if server.reset() is not False:
+                return
+        # no native reset: data goes away with basedir, server starts over
+        self.kill_server(server)
+        server.wipe()
+        if server.pidfile is not None and os.path.exists(server.pidfile):
+            os.unlink(server.pidfile)
+        self.start_server(server)
+
+    def reset_servers(self):
+        servers = self.order_servers()
+        errors = utils.run_graph(servers, self.server_deps, self.reset_server,
+                workers=self.config['concurrency'])
+        if errors:
+            utils.report_errors(servers, errors, 'reset')
+
+    def checkpoint_path(self, name):
+        return os.path.join(self.basedir, '.checkpoints', name)
+
+    def checkpoint(self, name='default'):
+        path = self.checkpoint_path(name)
+        if os.path.exists(path):
+            trash.dispose(path)
+        os.makedirs(path)
         servers = self.order_servers()
         for s in servers:
-            sys.stderr.write("Starting {0}\n".format(s.name))
-            s.prepare()
-            s.start()
-            s.wait_ready()
-            s.fill()
+            s.flush()
+        # all servers are stopped at once, so the state is consistent across them
+        paused = []
+        try:
+            for s in servers:
+                s.pause()
+                paused.append(s)
+            errors = utils.run_graph(servers, lambda s: [], lambda s: s.checkpoint(os.path.join(path, s.name)),
+                    workers=self.config['concurrency'])
+        finally:
+            for s in paused:
+                s.resume()
+        if errors:
+            utils.report_errors(servers, errors, 'checkpoint')
 
-    def run_command(self):
+    def rollback(self, name='default'):
+        # returns names of restarted servers, the others were untouched or reset natively
+        path = self.checkpoint_path(name)
+        assert os.path.isdir(path), "no checkpoint " + name
+        restarted = []
+
+        def rollback_server(server):
+            if server.rollback(os.path.join(path, server.name)):
+                restarted.append(server.name)
+        servers = self.order_servers()
+        errors = utils.run_graph(servers, self.server_deps, rollback_server,
+                workers=self.config['concurrency'])
+        if errors:
+            utils.report_errors(servers, errors, 'rollback')
+        return restarted
+
+    def spawn_command(self):
         if len(self.args.command) > 0:
             cmd = self.args.command
         else:
@@ -191,41 +332,209 @@ class Runner(object):
         environ.update(self.environ)
         environ = { k: str(v) for k, v in environ.items() }
         try:
-            p = subprocess.Popen(cmd, stdout=self.orig_stdout, stderr=self.orig_stderr, env=environ)
+            return subprocess.Popen(cmd, stdout=self.orig_stdout, stderr=self.orig_stderr, env=environ)
         except Exception as e:
             raise Exception("can't start {0}: {1}".format(' '.join(cmd), str(e)))
-        p.wait()
-        self.exit_code = p.returncode
+
+    def run_command(self):
+        if self.shards:
+            self.commands = [ s.spawn_command() for s in self.shards ]
+        else:
+            self.commands = [ self.spawn_command() ]
+        if self.crashed:
+            self.terminate_commands()  # server died before the command was there to abort
+        codes = [ p.wait() for p in self.commands ]
+        self.exit_code = ([ c for c in codes if c ] or [ 0 ])[0]
+        if self.crashed and self.exit_code <= 0:
+            self.exit_code = 1
+
+    def terminate_commands(self):
+        for p in self.commands:
+            if p.poll() is None:
+                p.terminate()
+
+    def make_shard(self, index):
+        shard = Runner()
+        shard.args = self.args
+        shard.confdir = self.confdir
+        shard.config = copy.deepcopy(self.config)
+        shard.config.update(basedir=os.path.join(self.basedir, 'shard{0}'.format(index)),
+                            basedir_cleanup=False, shards=1)
+        shard.config_hash = self.config_hash
+        shard.cache = self.cache
+        shard.tracer = self.tracer
+        shard.config['trace'] = None
+        shard.orig_stdout = self.orig_stdout
+        shard.orig_stderr = self.orig_stderr
+        shard.environ['TESTENV_SHARD'] = str(index)
+        shard.environ['TESTENV_SHARDS'] = str(self.config['shards'])
+        return shard
+
+    def start_shard(self, shard):
+        shard.create_basedir()
+        shard.parametrize_config()
+        shard.create_servers()
+        shard.start_servers()
+
+    def start_shards(self):
+        self.shards = [ self.make_shard(i) for i in range(self.config['shards']) ]
+        errors = utils.run_graph(self.shards, lambda s: [], self.start_shard)
+        if errors:
+            utils.report_errors(self.shards, errors, 'start', 'shards', lambda s: s.environ['TESTENV_SHARD'])
+
+    def stop_shards(self):
+        utils.run_graph(self.shards, lambda s: [], lambda s: s.teardown(), keep_going=True)
+
+    def stop_server(self, server):
+        try:
+            if server.is_running():
+                sys.stderr.write("Stoping {0}\n".format(server.name))
+                if self.supervisor is not None:
+                    self.supervisor.expect_exit(server)
+                with self.tracer.span(server.name + '.stop', 'server', server=server.name):
+                    server.stop()
+        except Exception:
+            # dependencies should be stopped anyway
+            sys.stderr.write("Server {0} failed to stop:\n".format(server.name))
+            traceback.print_exc(file=sys.stderr)
+
+    def kill_server(self, server):
+        if self.supervisor is not None:
+            self.supervisor.expect_exit(server)
+        with self.tracer.span(server.name + '.kill', 'server', server=server.name):
+            server.kill()
+
+    def respawn_server(self, server):
+        # start again after a stop or crash, data is kept
+        if server.pidfile is not None and os.path.exists(server.pidfile):
+            os.unlink(server.pidfile)  # stale pid should not be taken for the new one
+        with self.tracer.span(server.name + '.respawn', 'server', server=server.name):
+            server.start()
+            server.wait_ready()
 
     def stop_servers(self):
         servers = self.order_servers()
-        for s in reversed(servers):
-            if s.is_running():
-                sys.stderr.write("Stoping {0}\n".format(s.name))
-                s.stop()
+
+        dependants = dict((s, []) for s in servers)
+        for s in servers:
+            for d in self.server_deps(s):
+                dependants[d].append(s)
+        utils.run_graph(servers, dependants.get, self.stop_server, workers=self.config['concurrency'])
 
     def cleanup(self):
+        self.ports.release()
         if self.config['basedir_cleanup'] or self.config['basedir'] == self.BASEDIR_TEMP:
-            shutil.rmtree(self.basedir)
+            self.remove_basedir()
+
+    def all_servers(self):
+        if self.shards:
+            return dict(('shard{0}/{1}'.format(i, name), s)
+                        for i, shard in enumerate(self.shards) for name, s in shard.servers.items())
+        return dict(self.servers)
+
+    def start_monitor(self):
+        if self.config['monitor'] is None:
+            return
+        interval = self.config['monitor'].get('interval', 1.0)
+        self.monitor = monitor.Monitor(self.all_servers(), interval, self.basepath('monitor.jsonl'))
+        self.monitor.start()
+
+    def stop_monitor(self):
+        if self.monitor is None:
+            return
+        self.monitor.stop()
+        self.orig_stderr.write(self.monitor.report())
+        violations = self.monitor.violations()
+        for v in violations:
+            self.orig_stderr.write("Limit exceeded: " + v + "\n")
+        if violations and not self.exit_code:
+            self.exit_code = 1
+        self.monitor = None
+
+    def start_supervisor(self):
+        if not self.config['supervise']:
+            return
+        self.supervisor = supervisor.Supervisor(self.all_servers(), self.server_crashed)
+        self.supervisor.start()
+
+    def stop_supervisor(self):
+        if self.supervisor is None:
+            return
+        self.supervisor.stop()
+        self.supervisor = None
+
+    def server_crashed(self, label, server):
+        out = self.orig_stderr
+        out.write("Server {0} (pid {1}) died, on_crash: {2}\n".format(label, server.pid, server.on_crash))
+        for path in server.log_files():
+            lines = utils.tail(path)
+            if lines:
+                out.write("--- {0}\n{1}\n---\n".format(path, lines))
+        out.flush()
+        if server.on_crash == 'log':
+            return
+        if server.on_crash == 'restart':
+            try:
+                self.respawn_server(server)
+                out.write("Server {0} restarted, pid {1}\n".format(label, server.pid))
+                return
+            except Exception:
+                traceback.print_exc(limit=100, file=out)
+                out.write("Server {0} restart failed, aborting\n".format(label))
+        self.crashed = True
+        self.terminate_commands()
+
+    def write_trace(self):
+        if self.config['trace'] is not None and os.path.isdir(self.basedir):
+            self.tracer.dump(self.basepath(self.config['trace']))
+
+    def setup(self):
+        self.create_cache()
+        with self.tracer.span('create_basedir'):
+            self.create_basedir()
+        self.open_log()
+        if self.config['shards'] > 1:
+            with self.tracer.span('start_shards'):
+                self.start_shards()
+            return
+        with self.tracer.span('parametrize_config'):
+            self.parametrize_config()
+        self.create_servers()
+        with self.tracer.span('start_servers'):
+            self.start_servers()
+
+    def teardown(self):
+        if os.getpid() == self.pid:
+            with self.tracer.span('stop_servers'):
+                self.stop_shards()
+                self.stop_servers()
+            with self.tracer.span('cleanup'):
+                self.cleanup()
+            if self.basedir is not None:
+                self.write_trace()  # removed basedir takes the trace with it
 
     def run(self):
         assert os.name == 'posix', "testenv support only unix now"
         self.parse_params()
         sys.path.append(self.confdir)
-        self.read_config()
+        with self.tracer.span('read_config'):
+            self.read_config()
+        if self.args.mode is not None:
+            daemon.main(self)
         self.setup_signals()
 
         try:
-            self.create_basedir()
-            self.open_log()
-            self.parametrize_config()
-            self.create_servers()
-            self.start_servers()
-            self.run_command()
+            self.setup()
+            self.start_monitor()
+            self.start_supervisor()
+            with self.tracer.span('command'):
+                self.run_command()
         except Exception:
             traceback.print_exc(limit=100, file=sys.stderr)
         finally:
-            if os.getpid() == self.pid:
-                self.stop_servers()
-                self.cleanup()
+            self.stop_supervisor()
+            self.stop_monitor()
+            self.teardown()
+        if self.args.timings:
+            self.orig_stderr.write(self.tracer.summary())
         sys.exit(self.exit_code)
@@ -3,16 +3,22 @@
 import os
 import os.path
 import shlex
+import signal
 import subprocess
 import sys
 
-from . import utils
+from . import probes, trash, utils
 
 
 class Server(object):
 
     command = None
     start_timeout = 5
+    stop_timeout = 5  # SIGTERM -> SIGKILL
+    limits = None     # { cpu: percent, rss: size, fds: count }
+    probe = 'connect'  # readiness probe, see probes.py
+    prober = None
+    on_crash = 'abort'  # abort | restart | log, see Runner.server_crashed
     pid = None
     pidfile = None
     stdout = None
@@ -20,12 +26,24 @@ class Server(object):
     environ = None
     address = None
     after = None
+    socket_activation = False
+    listen_backlog = 128
+    sockets = ()
+
+    ephemeral_config = None  # presets for throwaway data, see presets()
+    checkpoint_ignore = ('*.pid',)  # files not holding server state, see changed()
+
+    # options handled for every server type, even if init() ignores them
+    common_options = ('after', 'socket_activation', 'stop_timeout', 'limits', 'probe', 'on_crash')
 
     def __init__(self, runner, name, cfg):
         self.runner = runner
         self.name = name
         self.basedir = os.path.join(self.runner.basedir, self.name)
         self.init(**cfg)
+        for k in self.common_options:
+            if k in cfg:
+                setattr(self, k, cfg[k])
         if isinstance(self.after, list):
             pass
         elif self.after is None:
@@ -40,6 +58,12 @@ class Server(object):
     def confpath(self, path):
         return self.runner.confpath(path)
 
+    def presets(self):
+        # should be merged before user config, so every preset may be overridden
+        if self.runner.config.get('ephemeral') and self.ephemeral_config:
+            return self.ephemeral_config
+        return {}
+
     def basepath(self, path):
         if os.path.isabs(path):
             return path
@@ -50,14 +74,24 @@ class Server(object):
         os.makedirs(self.basedir)
 
     def start(self):
-        if self.stdout is not None:
+        # files are already open on restart
+        if isinstance(self.stdout, basestring):
             self.stdout = open(self.basepath(self.stdout), 'w')
-        if self.stderr is not None:
+        if isinstance(self.stderr, basestring):
             self.stderr = open(self.basepath(self.stderr), 'w')
         sys.stderr.write(" ".join(self.command) + "\n")
-        p = subprocess.Popen(self.command, stdout=self.stdout, stderr=self.stderr, env=self.environ, cwd=self.basedir)
+        if self.socket_activation:
+            self.start_activated()
+            return
+        # close_fds: servers are started from several threads, without it a server may inherit
+        # exec status pipe of a concurrent Popen and block it until the server exits (python2)
+        p = subprocess.Popen(self.command, stdout=self.stdout, stderr=self.stderr, env=self.environ, cwd=self.basedir,
+                             close_fds=True)
         if self.pidfile is not None:
-            self.pid = utils.wait_for_pid(self.pidfile, maxtime=self.start_timeout)
+            # daemonizing servers exit with 0 right after fork
+            self.pid = utils.wait_for_pid(self.pidfile, maxtime=self.start_timeout, alive=lambda: p.poll() in (None, 0))
+            if self.pid is None and p.poll():
+                raise Exception("server {0} exited with code {1}".format(self.name, p.returncode))
             if self.pid is None:
                 raise Exception("server {0} didn't started (pidfile)"
                         " in {1} seconds".format(self.name, self.start_timeout))
@@ -65,13 +99,50 @@ class Server(object):
             self.pid = p.pid
         sys.stderr.write("pid = " + str(self.pid) + "\n")
 
+    def bind_sockets(self):
+        assert self.address is not None, "socket_activation requires server address"
+        if not self.sockets:
+            self.sockets = [ utils.listen_socket(self.address, self.listen_backlog) ]
+        return self.sockets
+
+    def start_activated(self):
+        # LISTEN_PID should match the process using the sockets, so no daemons here
+        assert self.pidfile is None, "socket_activation can't be used for daemonizing servers"
+        self.bind_sockets()
+        self.pid = utils.spawn_process(self.command[0], self.command, env=self.environ, cwd=self.basedir,
+                stdout=self.stdout, stderr=self.stderr, sockets=self.sockets)
+        sys.stderr.write("pid = " + str(self.pid) + " (socket activated)\n")
+
+    def close_sockets(self):
+        for s in self.sockets:
+            s.close()
+        self.sockets = ()
+
     def is_ready(self):
-        if self.address is not None:
-            return utils.wait_for_socket(self.address, maxtime=0)
-        return True
+        if self.address is None:
+            return True
+        if self.prober is None:
+            self.prober = probes.make(self.probe, self.address)
+        if not self.prober.check():
+            return False
+        # activated sockets are ours, so the kernel queues the probe even with no server
+        # behind them; the server has to be alive and to have accepted it
+        return not self.sockets or (self.is_running() and not any(utils.accept_queue(s) for s in self.sockets))
 
     def wait_ready(self):
-        res = utils.wait_for(self.is_ready, maxtime=self.start_timeout)
+        watch = self.address is not None and utils.watcher_for(self.address) or None
+        try:
+            res = utils.wait_for(self.is_ready, maxtime=self.start_timeout, alive=self.is_running, watch=watch)
+        finally:
+            if watch is not None:
+                watch.close()
+            if self.prober is not None:
+                self.prober.close()
+                self.prober = None
+        if res and self.socket_activation and not self.is_running():
+            res = None  # the probe got into the backlog of our own socket, nobody serves it
+        if not res and not self.is_running():
+            raise Exception("server {0} exited before got ready".format(self.name))
         if not res:
             raise Exception("server {0} didn't got ready in {1} seconds".format(self.name, self.start_timeout))
 
@@ -81,13 +152,78 @@ class Server(object):
     def ctrl(self, *args):
         pass  # optional
 
+    def reset(self):
+        # optional, bring data to the state right after fill; False means
+        # there is no native way and the runner starts the server over
+        return False
+
+    def flush(self):
+        pass  # optional, push in-memory state to files before checkpoint
+
+    def pause(self):
+        # checkpoints copy files of stopped processes
+        if self.pid is not None:
+            utils.signal_tree(self.pid, signal.SIGSTOP)
+
+    def resume(self):
+        if self.pid is not None:
+            utils.signal_tree(self.pid, signal.SIGCONT)
+
+    def checkpoint(self, path):
+        # called between pause() and resume(), should save state under path
+        files = os.path.join(path, 'files')
+        utils.copy_tree(self.basedir, files)
+        utils.prune_special(files)
+
+    def changed(self, path):
+        # whether state differs from checkpoint at path, logs don't count
+        ignore = self.checkpoint_ignore + tuple(os.path.basename(f) for f in self.log_files())
+        return utils.tree_manifest(self.basedir, ignore) != utils.tree_manifest(os.path.join(path, 'files'), ignore)
+
+    def rollback(self, path):
+        # brings state of checkpoint at path back, True if the server was restarted
+        if not self.changed(path):
+            return False
+        self.runner.kill_server(self)
+        self.restore(path)
+        self.runner.respawn_server(self)
+        return True
+
+    def restore(self, path):
+        self.wipe()
+        utils.copy_tree(os.path.join(path, 'files'), self.basedir)
+
+    def wipe(self):
+        # drops basedir of a killed server
+        for attr in ('stdout', 'stderr'):
+            f = getattr(self, attr)
+            if hasattr(f, 'close'):
+                f.close()
+                setattr(self, attr, f.name)  # reopened in the new basedir by start()
+        trash.dispose(self.basedir)
+
+    def log_files(self):
+        # logs worth showing when the server dies
+        files = []
+        for f in (self.stdout, self.stderr):
+            path = getattr(f, 'name', f)
+            if isinstance(path, basestring) and self.basepath(path) not in files:
+                files.append(self.basepath(path))
+        return files
+
     def is_running(self):
         if self.pid is None:
             return False
-        return utils.is_running(self.pid)
+        return utils.is_running(self.pid, is_child=(self.pidfile is None))
 
     def stop(self):
-        utils.stop_with_signal(self.pid, is_child=(self.pidfile is None))
+        utils.stop_with_signal(self.pid, is_child=(self.pidfile is None), maxtime=self.stop_timeout)
+        self.close_sockets()
+
+    def kill(self):
+        # state is thrown away, no clean shutdown; activated sockets are kept for respawn
+        utils.signal_tree(self.pid, signal.SIGKILL)
+        utils.wait_exit(self.pid, is_child=(self.pidfile is None), maxtime=self.stop_timeout)
 
 
 class GenericServer(Server):
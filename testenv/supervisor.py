@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import os
+import select
+import threading
+
+from . import utils
+
+
+class Supervisor(object):
+    """
+    Watches server processes while the command runs and calls back as soon
+    as one of them dies. Sleeps on pidfds where the kernel has them (they
+    work for daemons from pidfiles as well as for children), polls every
+    interval otherwise.
+    """
+
+    def __init__(self, servers, callback, interval=0.5):
+        self.servers = servers  # { label: server }
+        self.callback = callback  # callback(label, server)
+        self.interval = interval
+        self.pidfds = {}  # pid -> fd
+        self.dead = set()  # reported pids
+        self.stopped = threading.Event()
+        self.wakeup = os.pipe()
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        os.write(self.wakeup[1], b'x')
+        self.thread.join()
+        for fd in self.pidfds.values():
+            os.close(fd)
+        self.pidfds = {}
+        for fd in self.wakeup:
+            os.close(fd)
+
+    def expect_exit(self, server):
+        # intentional stop is not a crash
+        if server.pid is not None:
+            self.dead.add(server.pid)
+
+    def loop(self):
+        while not self.stopped.is_set():
+            for label, server in sorted(self.servers.items()):
+                if self.stopped.is_set():
+                    break
+                if server.pid is None or server.pid in self.dead:
+                    continue
+                if not server.is_running():
+                    self.dead.add(server.pid)
+                    self.callback(label, server)
+            self.wait()
+
+    def wait(self):
+        pids = set(s.pid for s in self.servers.values() if s.pid is not None) - self.dead
+        for pid in list(self.pidfds):
+            if pid not in pids:
+                os.close(self.pidfds.pop(pid))
+        for pid in pids:
+            if pid not in self.pidfds:
+                fd = utils.pidfd_open(pid)
+                if fd is None:
+                    break
+                self.pidfds[pid] = fd
+        timeout = self.interval
+        if pids and len(self.pidfds) == len(pids):
+            timeout = None  # every process has a pidfd, sleep until something happens
+        select.select([ self.wakeup[0] ] + list(self.pidfds.values()), [], [], timeout)
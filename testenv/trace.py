@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import json
+import os
+import threading
+
+from . import utils
+
+
+class Tracer(object):
+    """
+    Records timed phases of a run. Dumps them as Chrome trace complete events
+    (chrome://tracing, Perfetto), one track per runner thread.
+    """
+
+    def __init__(self):
+        self.started = utils.monotonic()
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category='runner', **args):
+        start = utils.monotonic()
+        outcome = 'ok'
+        try:
+            yield
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            self.add(name, category, start, utils.monotonic(), outcome, args)
+
+    def add(self, name, category, start, end, outcome='ok', args=None):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start - self.started) * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': dict(args or {}, outcome=outcome),
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def dump(self, path):
+        with self.lock:
+            events = list(self.events)
+        with contextlib.closing(open(path, 'w')) as fh:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, fh, indent=1)
+
+    def summary(self, limit=10):
+        with self.lock:
+            events = sorted(self.events, key=lambda e: -e['dur'])
+        lines = [ "Slowest phases:" ]
+        for e in events[:limit]:
+            lines.append("{0:9.3f}s  {1}{2}".format(e['dur'] / 1e6, e['name'],
+                e['args']['outcome'] != 'ok' and ' (' + e['args']['outcome'] + ')' or ''))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import errno
+import fcntl
+import getpass
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import time
+
+from . import utils
+
+"""
+Basedir disposal off the critical path: a tree is renamed into a per-user
+trash dir next to it (same filesystem, so rename is atomic and instant)
+and a detached low priority collector deletes it. Whatever a killed
+collector left behind is picked up by the next collect().
+"""
+
+LOCK = '.lock'
+
+
+def location(path):
+    parent = os.path.dirname(os.path.realpath(path))
+    return os.path.join(parent, '.testenv-trash-' + getpass.getuser())
+
+
+def entries(trash):
+    # oldest first, names start with disposal time
+    try:
+        names = os.listdir(trash)
+    except OSError:
+        return []
+    return [ os.path.join(trash, n) for n in sorted(names) if n != LOCK ]
+
+
+def dispose(path, max_size=None):
+    trash = location(path)
+    try:
+        if not os.path.isdir(trash):
+            os.makedirs(trash)
+        dst = '{0:.6f}-{1}-{2}'.format(time.time(), os.getpid(), os.path.basename(path))
+        os.rename(path, os.path.join(trash, dst))
+    except OSError:
+        shutil.rmtree(path)  # rename isn't possible, do it the slow way
+        return
+    collect(trash, max_size)
+
+
+@contextlib.contextmanager
+def locked(trash):
+    # yields False while another collector works on trash
+    with contextlib.closing(open(os.path.join(trash, LOCK), 'a')) as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        yield True
+
+
+def collect(trash, max_size=None):
+    """
+    Removes oldest entries synchronously while trash is over max_size and
+    leaves the rest to a background collector.
+    """
+    if not entries(trash):
+        return
+    with locked(trash) as free:
+        if not free:
+            return  # collector is running and will see new entries
+        if max_size is not None:
+            sizes = [ (e, utils.tree_size(e)) for e in entries(trash) ]
+            total = sum(s for _, s in sizes)
+            for e, size in sizes:
+                if total <= max_size:
+                    break
+                shutil.rmtree(e, ignore_errors=True)
+                total -= size
+        if not entries(trash):
+            return
+    spawn_collector(trash)
+
+
+def spawn_collector(trash):
+    cmd = [ sys.executable, '-m', 'testenv.trash', trash ]
+    if utils.find_binary('ionice'):
+        cmd = [ 'ionice', '-c', '3' ] + cmd
+    if utils.find_binary('nice'):
+        cmd = [ 'nice', '-n', '19' ] + cmd
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in [ os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                     env.get('PYTHONPATH') ] if p)
+    with contextlib.closing(open(os.devnull, 'r+')) as devnull:
+        subprocess.Popen(cmd, env=env, stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+
+def main(trash):
+    with locked(trash) as free:
+        if not free:
+            return
+        # entries which survived a removal (foreign files, busy mounts) are
+        # not retried, the next collect() spawns a collector anyway
+        failed = set()
+        while True:
+            pending = [ e for e in entries(trash) if e not in failed ]
+            if not pending:
+                break
+            for e in pending:
+                if os.path.isdir(e) and not os.path.islink(e):
+                    shutil.rmtree(e, ignore_errors=True)
+                else:
+                    try:
+                        os.unlink(e)
+                    except OSError:
+                        pass
+                if os.path.lexists(e):
+                    failed.add(e)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
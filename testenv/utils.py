@@ -1,40 +1,157 @@
 # -*- coding: utf-8 -*-
 
+import atexit
+import binascii
+import collections
 import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import fnmatch
 import getpass
+import json
 import os
+import platform
+import select
+import shutil
 import signal
 import socket
+import stat
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+import traceback
 
 import yaml
 
 
 user = getpass.getuser()
 
-promised_ports = {}
-
 proto_aliases = {
     'tcp': socket.SOCK_STREAM,
     'udp': socket.SOCK_DGRAM,
 }
 
 
+def can_bind(ip, port, proto='tcp'):
+    s = socket.socket(socket.AF_INET, proto_aliases[proto])
+    try:
+        s.bind((ip, port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def ephemeral_ports():
+    # (first, last) ports the kernel picks for outgoing connections
+    try:
+        with contextlib.closing(open('/proc/sys/net/ipv4/ip_local_port_range')) as fh:
+            first, last = fh.read().split()
+            return int(first), int(last)
+    except (IOError, ValueError):
+        return None
+
+
+class PortLease(object):
+    """
+    Port allocator. Environments lease whole blocks of ports in a table
+    shared by all testenv processes of the user (a json file guarded by
+    flock on a sibling lock file and replaced by rename, so a crash never
+    leaves it half written), concurrent runs never compete for the same
+    ports. Ports of other users are skipped by can_bind. Blocks of dead
+    owners are reclaimed, release() gives ours back. Ports are taken out of
+    the kernel's ephemeral range, otherwise any outgoing connection (even a
+    readiness probe) may occupy a port leased to a server not started yet.
+    """
+
+    first_port = 10000
+    last_port = 65536
+    block_size = 64
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                                'testenv-ports-{0}.json'.format(os.getuid()))
+        self.path = path
+        self.owner = [ os.getpid(), binascii.hexlify(os.urandom(8)).decode() ]
+        self.blocks = []
+        self.next_port = self.end_port = 0
+        self.lock = threading.Lock()
+        ephemeral = ephemeral_ports()
+        if ephemeral is not None:
+            below = (self.first_port, min(self.last_port, ephemeral[0]))
+            above = (max(self.first_port, ephemeral[1] + 1), self.last_port)
+            self.first_port, self.last_port = max(below, above, key=lambda r: r[1] - r[0])
+
+    @contextlib.contextmanager
+    def table(self):
+        with contextlib.closing(open(self.path + '.lock', 'a')) as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                with contextlib.closing(open(self.path)) as fh:
+                    table = json.loads(fh.read())
+                assert isinstance(table, dict)
+            except (IOError, ValueError, AssertionError):
+                table = {}  # missing or damaged, leases of live runs are lost only
+            yield table
+            tmp = self.path + '.tmp'
+            with contextlib.closing(open(tmp, 'w')) as fh:
+                fh.write(json.dumps(table))
+            os.rename(tmp, self.path)
+
+    def lease_block(self):
+        nblocks = (self.last_port - self.first_port) // self.block_size
+        with self.table() as table:
+            # start probing from a pid dependent block, so concurrent
+            # runs usually get their block with the first attempt
+            for i in range(nblocks):
+                block = (self.owner[0] + i) % nblocks
+                owner = table.get(str(block))
+                if owner is not None and (owner[0] == self.owner[0] or is_running(owner[0])):
+                    continue
+                table[str(block)] = self.owner
+                return block
+        raise Exception("no free port blocks left in " + self.path)
+
+    def port(self, ip, proto='tcp'):
+        with self.lock:
+            while True:
+                if self.next_port >= self.end_port:
+                    block = self.lease_block()
+                    self.blocks.append(block)
+                    self.next_port = self.first_port + block * self.block_size
+                    self.end_port = self.next_port + self.block_size
+                port = self.next_port
+                self.next_port += 1
+                if can_bind(ip, port, proto):  # may be taken by non testenv process
+                    return str(port)
+
+    def release(self):
+        with self.lock:
+            if not self.blocks:
+                return
+            with self.table() as table:
+                for block in self.blocks:
+                    if table.get(str(block)) == self.owner:
+                        del table[str(block)]
+            self.blocks = []
+            self.next_port = self.end_port = 0
+
+
+_lease = []
+
+
 def free_port(ip, proto='tcp'):
-    for port in range(64000, 32768, -1):
-        if port in promised_ports:
-            continue
-        stype = proto_aliases[proto]
-        s = socket.socket(socket.AF_INET, stype)
-        try:
-            s.bind((ip, port))
-        except Exception:
-            continue
-        else:
-            promised_ports[port] = 1
-            s.close()
-        return str(port)
+    if not _lease:
+        _lease.append(PortLease())
+        atexit.register(_lease[0].release)
+    return _lease[0].port(ip, proto)
 
 
 def free_ip():
@@ -71,6 +188,15 @@ def merge(*args):
     return reduce(handle, args, {})
 
 
+def parse_size(size):
+    # 512, '64K', '16M', '2G' -> bytes
+    units = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+    size = str(size).strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def load_class(name):
     components = name.split('.')
     mod = __import__('.'.join(components[:-1]))
@@ -98,8 +224,77 @@ def write_yaml(path, cfg):
         fh.write(yaml.dump(cfg))
 
 
+def tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def copy_tree(src, dst, hardlink=False):
+    """
+    Copies content of src into dst as cheap as possible: reflinks where the
+    filesystem supports them, hardlinks when allowed (files should never be
+    modified in place then), plain copy otherwise.
+    """
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    if platform.system() == 'Linux':  # GNU cp
+        flag = hardlink and '--link' or '--reflink=auto'
+        subprocess.check_call(['cp', '-a', flag, os.path.join(src, '.'), dst])
+        return
+    for name in os.listdir(src):
+        s, d = os.path.join(src, name), os.path.join(dst, name)
+        if os.path.isdir(s) and not os.path.islink(s):
+            shutil.copytree(s, d, symlinks=True)
+        else:
+            shutil.copy2(s, d)
+
+
+def tree_manifest(path, ignore=()):
+    # { relative path: (size, mtime) } of regular files, names matching ignore patterns are skipped
+    manifest = {}
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            if any(fnmatch.fnmatch(f, pattern) for pattern in ignore):
+                continue
+            full = os.path.join(root, f)
+            try:
+                st = os.lstat(full)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                manifest[os.path.relpath(full, path)] = (st.st_size, st.st_mtime)
+    return manifest
+
+
+def prune_special(path):
+    # sockets and fifos of a copied tree would get in the way of servers creating them
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            full = os.path.join(root, f)
+            mode = os.lstat(full).st_mode
+            if stat.S_ISSOCK(mode) or stat.S_ISFIFO(mode):
+                os.unlink(full)
+
+
 # process controll funcs, may be move to separate module ?
 
+def tail(path, lines=20, chunk=65536):
+    try:
+        with contextlib.closing(open(path, 'rb')) as fh:
+            fh.seek(0, os.SEEK_END)
+            fh.seek(max(0, fh.tell() - chunk))
+            data = fh.read()
+    except (IOError, OSError):
+        return None
+    return b'\n'.join(data.splitlines()[-lines:]).decode('utf-8', 'replace')
+
+
 def is_exe(f):
     return os.path.isfile(f) and os.access(f, os.X_OK)
 
@@ -121,82 +316,432 @@ def find_binary(binary, cwd=None):
     return None
 
 
-def spawn_process(binary, args):
+def spawn_process(binary, args, env=None, cwd=None, stdout=None, stderr=None, sockets=()):
+    """
+    Forks and execs binary. Listening sockets are passed to the child as fds
+    3, 4, ... with LISTEN_FDS / LISTEN_PID set (sd_listen_fds convention).
+    """
     pid = os.fork()
     if not pid:
-        os.execvp(binary, args)
+        try:
+            if cwd is not None:
+                os.chdir(cwd)
+            if stdout is not None:
+                os.dup2(stdout.fileno(), 1)
+            if stderr is not None:
+                os.dup2(stderr.fileno(), 2)
+            env = dict(os.environ if env is None else env)
+            if sockets:
+                # move fds above the target range first, dup2 makes them inheritable
+                fds = [ fcntl.fcntl(s.fileno(), fcntl.F_DUPFD, 3 + len(sockets)) for s in sockets ]
+                for i, fd in enumerate(fds):
+                    os.dup2(fd, 3 + i)
+                    os.close(fd)
+                env['LISTEN_FDS'] = str(len(sockets))
+                env['LISTEN_PID'] = str(os.getpid())
+            close_fds(range(3, 3 + len(sockets)))
+            os.execvpe(binary, args, env)
+        finally:
+            os._exit(127)
     else:
         return pid
 
 
-def wait_for(cb, sleeptime=0.1, maxtime=5):
-    sleeptotal = 0
-    while (maxtime > 0 and sleeptotal <= maxtime) or (maxtime == sleeptotal == 0):
+def accept_queue(sock):
+    # connections waiting for accept() on a listening tcp socket, 0 when unknown
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return 0
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, getattr(socket, 'TCP_INFO', 11), 104)
+    except socket.error:
+        return 0
+    return struct.unpack_from('I', info, 24)[0]  # tcpi_unacked of a listener is its accept queue
+
+
+def close_fds(keep=()):
+    # for forked children: fds of the parent (pipes of Popen in other threads,
+    # pidfds, sockets) would otherwise stay open until exit
+    try:
+        fds = [ int(fd) for fd in os.listdir('/proc/self/fd') ]
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass  # listdir's own fd
+
+
+def listen_socket(addr, backlog=128):
+    family, addr = parse_address(addr)
+    s = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.unlink(addr)
+    else:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(addr)
+    s.listen(backlog)
+    return s
+
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+_libc = []
+
+
+def libc():
+    if not _libc:
+        try:
+            _libc.append(ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True))
+        except Exception:
+            _libc.append(None)
+    return _libc[0]
+
+
+class DirWatcher(object):
+    """
+    Sleeps until something is created or written in a directory (inotify),
+    degrades to plain sleeping where inotify is not available.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, path):
+        self.fd = None
+        lib = libc()
+        if lib is None or not hasattr(lib, 'inotify_init1') or not os.path.isdir(path):
+            return
+        fd = lib.inotify_init1(os.O_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            return
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if lib.inotify_add_watch(fd, path, mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        while r:
+            try:
+                os.read(self.fd, 4096)
+            except OSError:
+                break
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def wait_for(cb, sleeptime=0.1, maxtime=5, alive=None, watch=None):
+    """
+    Calls cb until it returns something true, gives up after maxtime seconds
+    or as soon as alive() says the process behind cb is gone. Pauses grow
+    from 1ms up to sleeptime, with a DirWatcher we sleep on its events instead.
+    """
+    deadline = monotonic() + maxtime
+    delay = 0.001
+    while True:
         res = cb()
         if res:
             return res
-        time.sleep(sleeptime)
-        sleeptotal += sleeptime
-    return None
+        if alive is not None and not alive():
+            return None
+        left = deadline - monotonic()
+        if left <= 0:
+            return None
+        if watch is not None and watch.fd is not None:
+            watch.wait(min(sleeptime, left))
+        else:
+            time.sleep(min(delay, left))
+            delay = min(delay * 2, sleeptime)
 
 
-def wait_for_pid(pidfile, sleeptime=0.1, maxtime=5):
-    sleeptotal = 0
-    while (maxtime > 0 and sleeptotal <= maxtime) or (maxtime == sleeptotal == 0):
-        try:
-            with contextlib.closing(open(pidfile, "r")) as fh:
-                return int(fh.readline().strip())
-        except IOError:
-            pass
-        time.sleep(sleeptime)
-        sleeptotal += sleeptime
-    return None
+def read_pid(pidfile):
+    try:
+        with contextlib.closing(open(pidfile, "r")) as fh:
+            return int(fh.readline().strip())
+    except (IOError, ValueError):
+        return None  # missed or not written yet
 
 
-def is_running(pid):
+def wait_for_pid(pidfile, sleeptime=0.1, maxtime=5, alive=None):
+    watch = DirWatcher(os.path.dirname(os.path.abspath(pidfile)))
+    try:
+        return wait_for(lambda: read_pid(pidfile), sleeptime=sleeptime, maxtime=maxtime, alive=alive, watch=watch)
+    finally:
+        watch.close()
+
+
+def is_running(pid, is_child=False):
+    if is_child:
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return False
+        except OSError:
+            return False  # already reaped
     try:
         os.kill(pid, 0)
-        return True
-    except Exception:
+    except OSError as e:
+        return e.errno == errno.EPERM  # alive, but owned by another user
+    # exited daemon stays a zombie until its parent (init, which in containers
+    # is often slow or never reaps) collects it
+    return not is_zombie(pid)
+
+
+def is_zombie(pid):
+    try:
+        with contextlib.closing(open('/proc/{0}/stat'.format(pid))) as fh:
+            return fh.read().rsplit(')', 1)[1].split()[0] == 'Z'
+    except (IOError, IndexError):
         return False
 
 
-def stop_with_signal(pid, as_group=False, is_child=False, term=signal.SIGTERM, maxtime=5, sleeptime=0.1):
-    sleeptotal = 0
+def process_tree(pid):
+    # pid and all its descendants, parents go first
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with contextlib.closing(open('/proc/{0}/stat'.format(entry))) as fh:
+                    ppid = int(fh.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree = [ pid ]
+    for p in tree:
+        tree.extend(children.get(p, []))
+    return tree
+
+
+def signal_tree(pid, sig):
+    for p in process_tree(pid):
+        try:
+            os.kill(p, sig)
+        except OSError:
+            pass  # exited meanwhile
+
+
+def pidfd_open(pid):
+    # python 3.9+ has it in os, otherwise raw syscall (same number on all linux arches)
+    try:
+        if hasattr(os, 'pidfd_open'):
+            return os.pidfd_open(pid)
+        lib = libc()
+        if lib is not None and platform.system() == 'Linux':
+            fd = lib.syscall(434, pid, 0)
+            if fd >= 0:
+                return fd
+    except OSError:
+        pass
+    return None
+
+
+def wait_exit(pid, is_child=False, maxtime=5):
+    """
+    Waits for process exit: sleeps on pidfd where the kernel supports it,
+    polls with growing pauses otherwise. Children are reaped.
+    """
+    deadline = monotonic() + maxtime
+    fd = pidfd_open(pid)
+    if fd is not None:
+        try:
+            select.select([fd], [], [], maxtime)
+        finally:
+            os.close(fd)
+    return bool(wait_for(lambda: not is_running(pid, is_child), maxtime=max(0, deadline - monotonic())))
+
+
+def stop_with_signal(pid, as_group=False, is_child=False, term=signal.SIGTERM, maxtime=5):
     kpid = as_group and -pid or pid
-    while (maxtime > 0 and sleeptotal <= maxtime) or (maxtime == sleeptotal == 0):
-        if is_child:
-            os.waitpid(pid, os.P_NOWAIT)
-        if not is_running(pid):
-            return True
-        os.kill(kpid, term)
-        time.sleep(sleeptime)
-        sleeptotal += sleeptime
-    if not is_running(pid):
+    if not is_running(pid, is_child):
+        return True
+    os.kill(kpid, term)
+    if wait_exit(pid, is_child, maxtime):
         return True
     os.kill(kpid, signal.SIGKILL)
+    wait_exit(pid, is_child, 1)
     return False
 
 
-def wait_for_socket(addr, maxtime=5, sleeptime=0.1, timeout=0.01):
-    sleeptotal = 0
-    if isinstance(addr, tuple) or isinstance(addr, list):
-        family = socket.AF_INET
-        addr = (addr[0], int(addr[1]))
-    else:
-        family = socket.AF_UNIX
+def parse_address(addr):
+    # (ip, port) or [ip, port] is tcp, string is unix socket path
+    if isinstance(addr, (tuple, list)):
+        return socket.AF_INET, (addr[0], int(addr[1]))
+    return socket.AF_UNIX, addr
+
+
+def try_connect(addr, timeout=0.01):
+    family, addr = parse_address(addr)
     s = socket.socket(family, socket.SOCK_STREAM)
-    s.settimeout(timeout)
-    while (maxtime > 0 and sleeptotal <= maxtime) or (maxtime == sleeptotal == 0):
+    try:
+        s.setblocking(0)
+        err = s.connect_ex(addr)
+        if err in (errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK):
+            _, w, _ = select.select([], [s], [], timeout)
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) if w else errno.ETIMEDOUT
+        return err == 0
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def watcher_for(addr):
+    # unix sockets appear as files, so we may wake up on their creation
+    if parse_address(addr)[0] == socket.AF_UNIX:
+        return DirWatcher(os.path.dirname(os.path.abspath(addr)))
+    return None
+
+
+def wait_for_socket(addr, maxtime=5, sleeptime=0.1, timeout=0.01, alive=None):
+    watch = watcher_for(addr)
+    try:
+        return bool(wait_for(lambda: try_connect(addr, timeout), sleeptime=sleeptime, maxtime=maxtime,
+                             alive=alive, watch=watch))
+    finally:
+        if watch is not None:
+            watch.close()
+
+
+def order_graph(nodes, deps, kind='nodes', name=str):
+    # nodes with every node after its deps, raises on dependency cycles
+    ordered = []
+    visited = set()
+    stack = []
+
+    def add(node):
+        if node in stack:
+            bad = ', '.join(name(n) for n in stack[stack.index(node):])
+            raise Exception("dependency cycle with {0}: {1}".format(kind, bad))
+        if node in visited:
+            return
+        stack.append(node)
+        for d in deps(node):
+            add(d)
+        ordered.append(node)
+        visited.add(node)
+        stack.pop()
+    for node in nodes:
+        add(node)
+    return ordered
+
+
+def run_graph(nodes, deps, cb, workers=0, keep_going=False):
+    """
+    Calls cb(node) for every node from a pool of threads. A node is started
+    only when all nodes from deps(node) are done, nodes depending on a failed
+    one are skipped. Unless keep_going is set, no new nodes are started after
+    the first failure. Returns { node: exc_info } for failed nodes, nodes
+    never reached because of a dependency cycle are reported failed too.
+    An exception in the calling thread (a signal) lets running callbacks
+    finish, starts nothing new and is raised after the workers are gone.
+    """
+    nodes = list(nodes)
+    # graph is resolved once, picking the next node is O(1) then
+    known = set(nodes)
+    blockers = dict((node, set(d for d in deps(node) if d in known)) for node in nodes)
+    dependants = dict((node, []) for node in nodes)
+    for node in nodes:
+        for d in blockers[node]:
+            dependants[d].append(node)
+    ready = collections.deque(node for node in nodes if not blockers[node])
+    if workers <= 0 or workers > len(nodes):
+        workers = len(nodes)
+    cond = threading.Condition()
+    left = [ len(nodes) ]  # neither finished nor skipped
+    running = [ 0 ]
+    started = set()
+    aborted = [ False ]
+    failed = {}
+
+    def stopped():
+        return aborted[0] or (failed and not keep_going)
+
+    def skip(node):
+        for n in dependants[node]:
+            if n in blockers:
+                del blockers[n]
+                left[0] -= 1
+                skip(n)
+
+    def worker():
+        while True:
+            with cond:
+                while not ready:
+                    if not left[0] or not running[0] or stopped():
+                        return  # no running node means the rest is blocked by a cycle
+                    cond.wait()
+                if stopped():
+                    return
+                node = ready.popleft()
+                started.add(node)
+                running[0] += 1
+            error = None
+            try:
+                cb(node)
+            except Exception:
+                error = sys.exc_info()
+            with cond:
+                left[0] -= 1
+                running[0] -= 1
+                if error is None:
+                    for n in dependants[node]:
+                        if n in blockers:
+                            blockers[n].discard(node)
+                            if not blockers[n]:
+                                ready.append(n)
+                else:
+                    failed[node] = error
+                    skip(node)
+                cond.notify_all()
+
+    threads = [ threading.Thread(target=worker) for i in range(workers) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(1)  # keep main thread responsive to signals
+    except BaseException:
+        with cond:
+            aborted[0] = True
+            cond.notify_all()
+        for t in threads:
+            t.join()  # callbacks in progress finish, so their results (pids) are known to the caller
+        raise
+    if left[0] and (keep_going or not failed):
+        unreached = [ node for node in nodes if node in blockers and node not in started ]
         try:
-            s.connect(addr)
-            s.close()
-            return True
-        except socket.error:
-            pass
-        time.sleep(sleeptime)
-        sleeptotal += sleeptime
-    return False
+            raise Exception("dependency cycle blocks: " + ', '.join(str(node) for node in unreached))
+        except Exception:
+            error = sys.exc_info()
+        for node in unreached:
+            failed[node] = error
+    return failed
+
+
+def report_errors(nodes, errors, what, kind='servers', label=lambda s: s.name):
+    # errors of run_graph() go to stderr in order of nodes, then one exception for all
+    failed = [ node for node in nodes if node in errors ]
+    for node in failed:
+        sys.stderr.write("{0} {1} failed to {2}:\n".format(kind[:-1].capitalize(), label(node), what))
+        traceback.print_exception(*errors[node], file=sys.stderr)
+    raise Exception("failed to {0} {1}: {2}".format(what, kind, ', '.join(label(node) for node in failed)))
 
 
 def wait_for_proc(p, name=None):
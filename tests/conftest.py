@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+
+import pytest
+from testenv import Environment, utils
+
+
+@pytest.fixture
+def env(tmpdir):
+    server = { 'type': 'testenv.server.GenericServer', 'command': 'sleep 1000' }
+    config = {
+        'basedir': str(tmpdir.join('tenv')),
+        'template_cache': False,
+        'servers': { 'a': dict(server), 'b': dict(server) },
+    }
+    with Environment(config, confdir=str(tmpdir)) as env:
+        yield env
+
+
+def test_rollback_without_changes_keeps_servers(env):
+    pids = dict((name, env.server(name).pid) for name in ('a', 'b'))
+    env.checkpoint()
+    assert env.has_checkpoint()
+    assert env.rollback() == []
+    assert dict((name, env.server(name).pid) for name in ('a', 'b')) == pids
+
+
+def test_rollback_restarts_changed_server(env):
+    a, b = env.server('a'), env.server('b')
+    with open(os.path.join(a.basedir, 'kept'), 'w') as fh:
+        fh.write('before')
+    env.checkpoint()
+    old_a, old_b = a.pid, b.pid
+    with open(os.path.join(a.basedir, 'kept'), 'w') as fh:
+        fh.write('after checkpoint')
+    with open(os.path.join(a.basedir, 'added'), 'w') as fh:
+        fh.write('x')
+
+    assert env.rollback() == [ 'a' ]
+    assert not utils.is_running(old_a)
+    assert a.pid != old_a and a.is_running()
+    assert b.pid == old_b
+    with open(os.path.join(a.basedir, 'kept')) as fh:
+        assert fh.read() == 'before'
+    assert not os.path.exists(os.path.join(a.basedir, 'added'))
+    assert env.rollback() == []
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import subprocess
+import sys
+
+import pytest
+from testenv import daemon, Environment, utils
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'scripts', 'testenv')
+
+SERVER = """#!/bin/sh
+echo started >> data
+exec sleep 1000
+"""
+
+
+def testenv(*args, **kwargs):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.Popen([ sys.executable, SCRIPT ] + list(args), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, **kwargs)
+
+
+@pytest.fixture
+def config(tmpdir):
+    server = tmpdir.join('server.sh')
+    server.write(SERVER)
+    server.chmod(0o755)
+    path = tmpdir.join('testenv.yml')
+    path.write("basedir: tenv\ntemplate_cache: false\n"
+               "servers:\n  gen:\n    type: testenv.server.GenericServer\n    command: ./server.sh\n")
+    yield str(path)
+    testenv('stop', '--config', str(path)).communicate()
+    base = os.path.splitext(daemon.socket_path(str(path)))[0]
+    for f in (base + '.log', base + '.lock'):
+        if os.path.exists(f):
+            os.unlink(f)
+
+
+def test_reset_starts_generic_server_over(tmpdir):
+    config = {
+        'basedir': str(tmpdir.join('tenv')),
+        'template_cache': False,
+        'servers': { 'a': { 'type': 'testenv.server.GenericServer', 'command': 'sleep 1000' } },
+    }
+    with Environment(config, confdir=str(tmpdir)) as env:
+        a = env.server('a')
+        old = a.pid
+        with open(os.path.join(a.basedir, 'data'), 'w') as fh:
+            fh.write('left by a test')
+        env.reset()
+        assert not utils.is_running(old)
+        assert a.pid != old and a.is_running()
+        assert not os.path.exists(os.path.join(a.basedir, 'data'))
+
+
+def test_concurrent_clients_share_one_daemon(config):
+    data = os.path.join(os.path.dirname(config), 'tenv', 'gen', 'data')
+    clients = [ testenv('run', '--config', config, 'cat', data) for i in range(3) ]
+    results = [ p.communicate() + (p.returncode,) for p in clients ]
+    for out, err, code in results:
+        assert code == 0, err
+        assert out == 'started\n'  # every run after the first one got the server started over
+    assert sum(err.count('Started testenv daemon') for out, err, code in results) == 1
+
+
+def test_runner_only_options_reuse_daemon(config):
+    first = testenv('run', '--config', config, 'true')
+    out, err = first.communicate()
+    assert first.returncode == 0, err
+    second = testenv('run', '--monitor', '1', '--config', config, 'true')
+    out, err = second.communicate()
+    assert second.returncode == 0, err
+    assert 'stale' not in err
+    assert 'Started testenv daemon' not in err
+
+
+def test_shards_are_not_served(config):
+    p = testenv('run', '--shards', '2', '--config', config, 'true')
+    out, err = p.communicate()
+    assert p.returncode != 0
+    assert 'shards are supported by one-shot runs only' in err
+    assert 'Started testenv daemon' not in err
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+pytest_plugins = 'pytester'
+
+CONFIG = """
+basedir: tenv
+servers:
+  sleeper:
+    type: testenv.server.GenericServer
+    command: sleep 1000
+"""
+
+TEST = """
+import os
+
+
+def test_basedir(testenv):
+    assert testenv.basedir == os.path.join({confdir!r}, {basedir!r})
+    assert os.path.isdir(testenv.basedir)
+    assert testenv.server('sleeper').is_running()
+"""
+
+
+def run(testdir, basedir):
+    testdir.makefile('.yml', testenv=CONFIG)
+    testdir.makepyfile(TEST.format(confdir=str(testdir.tmpdir), basedir=basedir))
+    return testdir.runpytest('-p', 'testenv.pytest_plugin', '--testenv-config', 'testenv.yml')
+
+
+def test_session_environment(testdir, monkeypatch):
+    monkeypatch.delenv('PYTEST_XDIST_WORKER', raising=False)
+    run(testdir, 'tenv').assert_outcomes(passed=1)
+
+
+def test_xdist_worker_gets_own_basedir(testdir, monkeypatch):
+    monkeypatch.setenv('PYTEST_XDIST_WORKER', 'gw1')
+    run(testdir, 'tenv-gw1').assert_outcomes(passed=1)
+    assert not testdir.tmpdir.join('tenv').exists()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import pytest
+from testenv import Environment, utils
+
+ACCEPTOR = """
+import socket
+s = socket.fromfd(3, socket.AF_INET, socket.SOCK_STREAM)
+conns = []
+while True:
+    conns.append(s.accept()[0])
+"""
+
+
+def activated(tmpdir, command):
+    port = int(utils.free_port('127.0.0.1'))
+    server = { 'type': 'testenv.server.GenericServer', 'command': command, 'socket_activation': True,
+               'address': [ '127.0.0.1', port ], 'start_timeout': 10 }
+    config = { 'basedir': str(tmpdir.join('tenv')), 'template_cache': False, 'servers': { 's': server } }
+    return Environment(config, confdir=str(tmpdir))
+
+
+def test_activated_server_exiting_at_once_is_not_ready(tmpdir):
+    for attempt in range(5):  # used to pass the probe before the child was gone
+        with pytest.raises(Exception) as e:
+            with activated(tmpdir, '/bin/false'):
+                pass
+        assert 'failed to start servers: s' in str(e.value)
+
+
+def test_activated_server_accepting_is_ready(tmpdir):
+    tmpdir.join('acceptor.py').write(ACCEPTOR)
+    with activated(tmpdir, [ sys.executable, str(tmpdir.join('acceptor.py')) ]) as env:
+        assert env.server('s').is_running()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+
+import pytest
+from testenv import runner
+from testenv.contrib import tarantool
+
+
+@pytest.fixture
+def server(tmpdir):
+    tmpdir.join('init.lua').write("local a = require('lib.a')\nlocal json = require 'json'\n")
+    tmpdir.join('lib', 'a.lua').write('return require("lib.b")\n', ensure=True)
+    tmpdir.join('lib', 'b.lua').write('return 1\n')
+    tmpdir.join('lib', 'unused.lua').write('return 2\n')
+    r = runner.Runner()
+    r.confdir = str(tmpdir)
+    r.args = argparse.Namespace(config=None, mode=None, command=[], concurrency=None, shards=None,
+                                timings=False, monitor=None, template_cache=True)
+    r.read_config({ 'basedir': 'tenv', 'servers': {} })
+    r.basedir = str(tmpdir.join('tenv'))
+    return tarantool.Tarantool(r, 'tnt', { 'lua_script': 'init.lua', 'config': { 'listen': '127.0.0.1:3301' } })
+
+
+def test_snapshot_cache_is_opt_in(server):
+    server.runner.cache = object()
+    assert not server.use_cache()
+    server.snapshot_cache = True
+    assert server.use_cache()
+
+
+def test_lua_modules_follow_requires(server, tmpdir):
+    assert server.lua_modules() == [ str(tmpdir.join(f)) for f in ('init.lua', 'lib/a.lua', 'lib/b.lua') ]
+
+
+def test_snapshot_key_ignores_unrelated_files(server, tmpdir):
+    key = server.snapshot_key()
+    tmpdir.join('lib', 'unused.lua').write('return 3\n')
+    tmpdir.join('tenv', 'tnt', 'tarantool.lua').write('-- generated\n', ensure=True)
+    tmpdir.join('.testenv-trash-user', '1-tenv', 'old.lua').write('-- disposed\n', ensure=True)
+    assert server.snapshot_key() == key
+    tmpdir.join('lib', 'b.lua').write('return 4\n')
+    assert server.snapshot_key() != key
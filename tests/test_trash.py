@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import time
+
+from testenv import trash, utils
+
+
+def make_tree(path):
+    os.makedirs(os.path.join(path, 'sub'))
+    with open(os.path.join(path, 'sub', 'data'), 'w') as fh:
+        fh.write('x' * 1000)
+
+
+def test_dispose_renames_into_trash(tmpdir):
+    basedir = str(tmpdir.join('base'))
+    make_tree(basedir)
+    os.makedirs(trash.location(basedir))
+    with trash.locked(trash.location(basedir)) as free:
+        # held lock keeps collectors away, so the entry stays for inspection
+        assert free
+        trash.dispose(basedir)
+        assert not os.path.exists(basedir)
+        entries = trash.entries(trash.location(basedir))
+        assert len(entries) == 1
+        assert entries[0].endswith('-base')
+        assert os.path.exists(os.path.join(entries[0], 'sub', 'data'))
+
+
+def test_background_collector_empties_trash(tmpdir):
+    basedir = str(tmpdir.join('base'))
+    make_tree(basedir)
+    trash.dispose(basedir)
+    location = trash.location(basedir)
+    assert utils.wait_for(lambda: not trash.entries(location), maxtime=30)
+
+
+def test_collect_enforces_size_synchronously(tmpdir):
+    basedir = str(tmpdir.join('base'))
+    location = trash.location(basedir)
+    os.makedirs(location)
+    for i in range(3):
+        make_tree(basedir)
+        with trash.locked(location):
+            trash.dispose(basedir)
+        time.sleep(0.01)
+    assert len(trash.entries(location)) == 3
+    oldest = trash.entries(location)[0]
+    trash.collect(location, max_size=2500)
+    with trash.locked(location):
+        left = trash.entries(location)
+        assert oldest not in left
+        assert sum(utils.tree_size(e) for e in left) <= 2500
+
+
+def test_collector_gives_up_on_undeletable_entries(tmpdir, monkeypatch):
+    location = str(tmpdir.join('trash'))
+    make_tree(os.path.join(location, '1-stuck'))
+    calls = []
+
+    def rmtree(path, ignore_errors=False):
+        calls.append(path)
+        assert len(calls) < 10, "collector keeps retrying"
+    monkeypatch.setattr(trash.shutil, 'rmtree', rmtree)
+    trash.main(location)
+    assert len(calls) == 1
+    assert trash.entries(location) == [ os.path.join(location, '1-stuck') ]
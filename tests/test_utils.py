@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import signal
+import time
+
+import pytest
+from testenv import utils
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_run_graph_respects_deps():
+    done = []
+    deps = { 'a': [], 'b': [ 'a' ], 'c': [ 'b' ], 'd': [ 'a' ] }
+    assert utils.run_graph(sorted(deps), deps.get, done.append) == {}
+    assert sorted(done) == [ 'a', 'b', 'c', 'd' ]
+    assert done.index('a') < done.index('b') < done.index('c')
+
+
+def test_run_graph_skips_dependants_of_failed():
+    done = []
+
+    def cb(node):
+        if node == 'a':
+            raise Exception("a failed")
+        done.append(node)
+    deps = { 'a': [], 'b': [ 'a' ], 'c': [] }
+    failed = utils.run_graph(sorted(deps), deps.get, cb, keep_going=True)
+    assert list(failed) == [ 'a' ]
+    assert done == [ 'c' ]
+
+
+def test_run_graph_reports_cycles():
+    done = []
+    deps = { 'a': [ 'b' ], 'b': [ 'a' ], 'c': [], 'd': [ 'a' ] }
+    failed = utils.run_graph(sorted(deps), deps.get, done.append)
+    assert done == [ 'c' ]
+    assert sorted(failed) == [ 'a', 'b', 'd' ]
+    assert 'dependency cycle' in str(failed['a'][1])
+
+
+def test_run_graph_stops_workers_on_interrupt():
+    done = []
+
+    def cb(node):
+        time.sleep(0.5)
+        done.append(node)
+
+    def interrupt(signum, frame):
+        raise Interrupted()
+    old = signal.signal(signal.SIGALRM, interrupt)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, 0.2)
+        with pytest.raises(Interrupted):
+            utils.run_graph([ 'a', 'b' ], { 'a': [], 'b': [ 'a' ] }.get, cb)
+    finally:
+        signal.signal(signal.SIGALRM, old)
+    assert done == [ 'a' ]  # running callback finished before the exception got out
+    time.sleep(0.7)
+    assert done == [ 'a' ]
+
+
+def test_order_graph():
+    deps = { 'a': [ 'b', 'c' ], 'b': [ 'c' ], 'c': [], 'd': [] }
+    ordered = utils.order_graph(sorted(deps), deps.get)
+    assert sorted(ordered) == sorted(deps)
+    assert ordered.index('c') < ordered.index('b') < ordered.index('a')
+
+
+def test_order_graph_rejects_cycles():
+    deps = { 'a': [ 'b' ], 'b': [ 'c' ], 'c': [ 'b' ] }
+    with pytest.raises(Exception) as e:
+        utils.order_graph(sorted(deps), deps.get, 'databases')
+    assert str(e.value) == "dependency cycle with databases: b, c"
+
+
+def test_report_errors(capsys):
+    def cb(node):
+        raise Exception(node + " broke")
+    failed = utils.run_graph([ 'b', 'a' ], lambda n: [], cb, keep_going=True)
+    with pytest.raises(Exception) as e:
+        utils.report_errors([ 'b', 'a' ], failed, 'load', 'databases', lambda n: n)
+    assert str(e.value) == "failed to load databases: b, a"
+    err = capsys.readouterr()[1]
+    assert err.index("Database b failed to load:") < err.index("b broke") < err.index("Database a failed to load:")